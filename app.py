@@ -1,6 +1,8 @@
-from flask import Flask, jsonify, request
-from models import db, User, Beat, Text, Page, PageBlock
-from schemas import UserSchema, BeatSchema, TextSchema, PageSchema, PageBlocksSchema
+from flask import Flask, jsonify, request, send_file, Response, stream_with_context
+from models import db, User, Beat, BeatPattern, Text, Page, PageBlock, upgrade_schema
+from schemas import (UserSchema, BeatSchema, TextSchema, PageSchema, PageBlocksSchema, PageBlockItemSchema, BeatPatchSchema,
+                     BeatTransformSchema, BatchTransformSchema, RenderOptionsSchema, GrooveSchema, AttemptSchema)
+from blocks import replace_page_blocks, place_block, append_position, schedule_rebalance, resolve_blocks
 from flask_cors import CORS
 from marshmallow import ValidationError
 from functools import wraps
@@ -8,6 +10,36 @@ import os
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt, current_user
 from datetime import timedelta
 from sqlalchemy import or_
+import click
+from cleanup import collect_orphans
+from search import create_search_index, search, MAX_LIMIT as MAX_SEARCH_LIMIT
+from compression import backfill_compressed
+import time
+import io
+from werkzeug.utils import secure_filename
+from midi import beat_to_midi, stream_zip
+from cells import patch_cells, VersionConflict
+from patterns import create_pattern_triggers, migrate_beat_patterns, backfill_features, compact_patterns
+from features import FEATURE_COLUMNS
+import operator
+from facets import create_facet_triggers, facet_counts, facet_drift, rebuild_facets
+from transforms import transform_schemas
+from models import RenderJob
+from jobs import enqueue_render, cancel_render, render_path, run_worker, STALE_AFTER
+from events import stream_events, prune_events
+from timeline import beat_timeline, timeline_json, duration_ms, EVENT_STRUCT
+from grid import INSTRUMENTS
+from peaks import peak_pyramid, peaks_for_width, MAX_WIDTH
+from samplebank import ensure_default_kit, DEFAULT_KIT
+from models import Kit, GrooveTemplate
+from kits import read_wav, create_kit, MAX_KIT_UPLOAD
+from transcribe import transcribe, MAX_TRANSCRIBE_UPLOAD
+from models import PracticeAttempt
+from practice import align, score_attempt, pack_taps, create_progress_triggers, progress_summary
+from exercises import generate_exercises, LEVELS, MAX_EXERCISES
+from leaderboards import create_leaderboard_triggers, leaderboard, MAX_LIMIT
+from ngrams import create_ngram_index, rebuild_ngram_index, find_patterns, MAX_FRAGMENT
+from grid import encode_grid
 
 
 
@@ -20,6 +52,12 @@ jwt = JWTManager(app)
 #app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///your_database.db?check_same_thread=False'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///drum_website.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# render worker processes started by `flask render-worker`
+app.config['RENDER_CONCURRENCY'] = int(os.environ.get('RENDER_CONCURRENCY', 2))
+app.config['RENDER_DIR'] = os.path.join(app.instance_path, 'renders')
+app.config['PEAKS_DIR'] = os.path.join(app.instance_path, 'peaks')
+# preprocessed drum kits as float32 .npy files, memory-mapped by every worker (see samplebank.py)
+app.config['SAMPLE_BANK_DIR'] = os.path.join(app.instance_path, 'samples')
 
 db.init_app(app)
 
@@ -33,10 +71,27 @@ beat_schema = BeatSchema()
 text_schema = TextSchema()
 page_schema = PageSchema()
 page_block_schema = PageBlocksSchema()
+page_block_items_schema = PageBlockItemSchema(many=True)
+beat_patch_schema = BeatPatchSchema()
+beat_transform_schema = BeatTransformSchema()
+batch_transform_schema = BatchTransformSchema()
+render_options_schema = RenderOptionsSchema()
+groove_schema = GrooveSchema()
+attempt_schema = AttemptSchema()
 
 
 with app.app_context():
     db.create_all()
+    upgrade_schema()
+    with db.engine.begin() as connection:
+        create_search_index(connection)
+        create_pattern_triggers(connection)
+        migrate_beat_patterns(connection)
+        create_facet_triggers(connection)
+        create_progress_triggers(connection)
+        create_leaderboard_triggers(connection)
+        create_ngram_index(connection)
+    ensure_default_kit(app.config['SAMPLE_BANK_DIR'])
 
 
 def admin_required(fn):
@@ -120,13 +175,16 @@ def add_beat():
         data = beat_schema.load(request.get_json())
     except ValidationError as err:
         return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+    if data['groove_id'] is not None and not _owned_groove(data['groove_id'], data['user_id']):
+        return jsonify({'message': 'Groove not found'}), 404
 
     new_beat = Beat(
         beat_name=data['beat_name'],
         genre=data['genre'],
         bpm=data['bpm'],
         beat_schema=data['beat_schema'],
-        user_id=data['user_id']
+        user_id=data['user_id'],
+        groove_id=data['groove_id']
     )
 
     db.session.add(new_beat)
@@ -134,14 +192,74 @@ def add_beat():
     return jsonify({'message': 'beat added successfully'}), 200
 
 
+# turns a drum recording (multipart `audio`, a PCM WAV) into a new beat; optional form fields are beat_name,
+# genre and steps_per_bar. The file is analysed in chunks as it is read, up to transcribe.MAX_SECONDS of it.
+@app.route('/beats/transcribe', methods=['POST'])
+@jwt_required()
+def transcribe_beat():
+    request.max_content_length = MAX_TRANSCRIBE_UPLOAD
+    if 'audio' not in request.files:
+        return jsonify({'message': 'audio file is required'}), 400
+    try:
+        steps_per_bar = int(request.form.get('steps_per_bar', 16))
+    except ValueError:
+        steps_per_bar = None
+    if steps_per_bar not in (4, 8, 16, 32):
+        return jsonify({'message': 'steps_per_bar must be one of 4, 8, 16, 32'}), 400
+    try:
+        result = transcribe(request.files['audio'].stream, steps_per_bar)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+
+    try:
+        data = beat_schema.load({
+            'beat_name': request.form.get('beat_name', 'Transcription'),
+            'genre': request.form.get('genre', 'Transcription'),
+            'bpm': result['bpm'],
+            'beat_schema': result['beat_schema'],
+            'user_id': int(get_jwt_identity()),
+        })
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+
+    new_beat = Beat(**data)
+    db.session.add(new_beat)
+    db.session.commit()
+    return jsonify({'beat': beat_schema.dump(new_beat), 'onsets': result['onsets']}), 201
+
+
 @app.route('/beats', methods=['GET'])
 @jwt_required()
 def get_beats():
     user_id = int(get_jwt_identity())
-    beats = Beat.query.filter_by(user_id=user_id).all()
+    query = Beat.query.filter_by(user_id=user_id)
+
+    # range filters on the precomputed rhythmic features, e.g. ?min_density=0.2&max_syncopation=1
+    conditions = []
+    for column in FEATURE_COLUMNS:
+        for prefix, compare in (('min_', operator.ge), ('max_', operator.le)):
+            value = request.args.get(prefix + column)
+            if value is None:
+                continue
+            try:
+                conditions.append(compare(getattr(BeatPattern, column), float(value)))
+            except ValueError:
+                return jsonify({'message': f'{prefix + column} must be a number'}), 400
+    if conditions:
+        query = query.join(BeatPattern, Beat.pattern_id == BeatPattern.id).filter(*conditions)
+
+    beats = query.all()
     return jsonify([beat_schema.dump(beat) for beat in beats])
 
 
+# beat counts per genre and bpm bucket for the current user and over all users
+@app.route('/beats/facets', methods=['GET'])
+@jwt_required()
+def get_beat_facets():
+    user_id = int(get_jwt_identity())
+    return jsonify(facet_counts(db.session, user_id))
+
+
 @app.route('/beats/<int:id>', methods=['GET'])
 @jwt_required()
 def get_beat_by_id(id):
@@ -151,6 +269,221 @@ def get_beat_by_id(id):
     return beat_schema.dump(beat), 200
 
 
+# grooves are private to their owner: anyone else's template is treated as missing
+def _owned_groove(groove_id, user_id):
+    groove = GrooveTemplate.query.get(groove_id)
+    return groove if groove and groove.user_id == user_id else None
+
+
+# the groove to play a beat with: ?groove_id= (0 for straight time, else one of the caller's templates) or
+# else the beat's own; returns (groove dict or None, error response)
+def _playback_groove(beat, groove_id=None):
+    if groove_id is None:
+        return (beat.groove.to_dict() if beat.groove else None), None
+    if groove_id == 0:
+        return None, None
+    groove = _owned_groove(groove_id, int(get_jwt_identity()))
+    if not groove:
+        return None, (jsonify({'message': 'Groove not found'}), 404)
+    return groove.to_dict(), None
+
+
+# the best practice scores on a beat (beat_id 0: over all beats), top `limit` plus the caller's own rank
+@app.route('/leaderboards/<int:beat_id>', methods=['GET'])
+@jwt_required()
+def get_leaderboard(beat_id):
+    if beat_id != 0 and not Beat.query.get(beat_id):
+        return jsonify({'message': 'Beat not found'}), 404
+    limit = request.args.get('limit', 10, type=int)
+    if not 1 <= limit <= MAX_LIMIT:
+        return jsonify({'message': f'limit must be between 1 and {MAX_LIMIT}'}), 400
+    return jsonify(leaderboard(db.session, beat_id, int(get_jwt_identity()), limit))
+
+
+# generates `count` practice beats for a level (the caller's own level by default) and saves them in one go
+@app.route('/exercises/generate', methods=['POST'])
+@jwt_required()
+def generate_exercise_beats():
+    user = db.session.get(User, int(get_jwt_identity()))
+    if not user:
+        return jsonify({'message': 'User not found'}), 404
+    level = request.args.get('level', user.level)
+    if level not in LEVELS:
+        return jsonify({'message': f'level must be one of: {list(LEVELS)}'}), 400
+    count = request.args.get('count', 10, type=int)
+    if not 1 <= count <= MAX_EXERCISES:
+        return jsonify({'message': f'count must be between 1 and {MAX_EXERCISES}'}), 400
+
+    grids, bpms, difficulties = generate_exercises(level, count)
+    schemas = [encode_grid(grid) for grid in grids]
+    new_beats = [Beat(beat_name=f'{level.capitalize()} exercise {i + 1}', genre='exercise', bpm=int(bpm),
+                      pattern=pattern, user_id=user.id)
+                 for i, (bpm, pattern) in enumerate(zip(bpms, BeatPattern.for_schemas(schemas)))]
+    db.session.add_all(new_beats)
+    db.session.commit()
+    return jsonify([{**beat.to_dict(), 'difficulty': round(float(difficulty), 3)}
+                    for beat, difficulty in zip(new_beats, difficulties)]), 201
+
+
+# scores a play-along: taps per instrument (ms from the start of playback, over `loops` passes) are matched
+# to the beat's timeline; the attempt is stored and folded into the user's practice progress
+@app.route('/beats/<int:id>/attempts', methods=['POST'])
+@jwt_required()
+def add_attempt(id):
+    beat = Beat.query.get(id)
+    if not beat:
+        return jsonify({'message': 'Beat not found'}), 404
+    try:
+        data = attempt_schema.load(request.get_json())
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+    groove, _ = _playback_groove(beat)
+    try:
+        _, events = beat_timeline(beat.beat_schema, beat.bpm, groove)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+
+    taps = pack_taps(data['taps'])
+    stats = score_attempt(*align(events, duration_ms(beat.beat_schema, beat.bpm), taps, data['loops']))
+    attempt = PracticeAttempt(
+        user_id=int(get_jwt_identity()),
+        beat_id=beat.id,
+        beat_version=beat.version,
+        loops=data['loops'],
+        hits=stats['hits'],
+        misses=stats['misses'],
+        extras=stats['extras'],
+        mean_error_ms=stats['mean_error_ms'],
+        mean_abs_error_ms=stats['mean_abs_error_ms'],
+        score=stats['score'],
+        taps=taps.tobytes()
+    )
+    db.session.add(attempt)
+    db.session.commit()
+    return jsonify({'id': attempt.id, **stats}), 201
+
+
+@app.route('/progress', methods=['GET'])
+@jwt_required()
+def get_progress():
+    return jsonify(progress_summary(db.session, int(get_jwt_identity())))
+
+
+@app.route('/beats/<int:id>/export.mid', methods=['GET'])
+@jwt_required()
+def export_beat_midi(id):
+    beat = Beat.query.get(id)
+    if not beat:
+        return jsonify({'message': 'Beat not found'}), 404
+    groove, error = _playback_groove(beat, request.args.get('groove_id', type=int))
+    if error:
+        return error
+    try:
+        digest, data = beat_to_midi(beat.beat_schema, beat.bpm, groove)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+    return send_file(io.BytesIO(data), mimetype='audio/midi', as_attachment=True,
+                     download_name=f'{secure_filename(beat.beat_name) or "beat"}.mid', etag=digest)
+
+
+# absolute playback events (time_ms, instrument index, velocity) sorted by time; ?format=binary sends
+# them as packed little-endian '<fBB' records instead of JSON
+@app.route('/beats/<int:id>/timeline', methods=['GET'])
+@jwt_required()
+def get_beat_timeline(id):
+    beat = Beat.query.get(id)
+    if not beat:
+        return jsonify({'message': 'Beat not found'}), 404
+    output = request.args.get('format', 'json')
+    if output not in ('json', 'binary'):
+        return jsonify({'message': 'format must be json or binary'}), 400
+    groove, error = _playback_groove(beat, request.args.get('groove_id', type=int))
+    if error:
+        return error
+    try:
+        digest, events = beat_timeline(beat.beat_schema, beat.bpm, groove)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+
+    if output == 'binary':
+        response = Response(events.tobytes(), mimetype='application/octet-stream')
+        response.headers['X-Event-Struct'] = EVENT_STRUCT
+        response.headers['X-Instruments'] = ','.join(INSTRUMENTS)
+        response.headers['X-Duration-Ms'] = str(duration_ms(beat.beat_schema, beat.bpm))
+    else:
+        response = jsonify({'beat_id': beat.id, 'bpm': beat.bpm, 'instruments': INSTRUMENTS,
+                            'duration_ms': duration_ms(beat.beat_schema, beat.bpm), 'events': timeline_json(events)})
+    response.set_etag(f'{digest}-{output}')
+    return response.make_conditional(request)
+
+
+# the sample-bank kit for an optional kit_id of the current user; returns (kit, error response)
+def _render_kit(kit_id):
+    if kit_id is None:
+        return DEFAULT_KIT, None
+    kit = Kit.query.get(kit_id)
+    if not kit:
+        return None, (jsonify({'message': 'Kit not found'}), 404)
+    if kit.user_id != int(get_jwt_identity()):
+        return None, (jsonify({'message': 'You are not allowed to use this kit'}), 403)
+    return Kit.bank_name(kit.content_hash), None
+
+
+# waveform preview: ?width= (min, max) pairs over one rendered loop of the beat; ?kit_id= renders with a user kit
+@app.route('/beats/<int:id>/peaks', methods=['GET'])
+@jwt_required()
+def get_beat_peaks(id):
+    beat = Beat.query.get(id)
+    if not beat:
+        return jsonify({'message': 'Beat not found'}), 404
+    width = request.args.get('width', 512, type=int)
+    if not 1 <= width <= MAX_WIDTH:
+        return jsonify({'message': f'width must be between 1 and {MAX_WIDTH}'}), 400
+    kit, error = _render_kit(request.args.get('kit_id', type=int))
+    if error:
+        return error
+    groove, error = _playback_groove(beat, request.args.get('groove_id', type=int))
+    if error:
+        return error
+    try:
+        digest, levels = peak_pyramid(beat.beat_schema, beat.bpm, app.config['PEAKS_DIR'],
+                                      app.config['SAMPLE_BANK_DIR'], kit, groove)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+
+    peaks = peaks_for_width(levels, width)
+    response = jsonify({'beat_id': beat.id, 'width': len(peaks), 'peaks': peaks.astype(float).round(4).tolist()})
+    response.set_etag(f'{digest}-{width}')
+    return response.make_conditional(request)
+
+
+# streams a zip of the current user's beats as MIDI files, loading and converting them in chunks
+@app.route('/beats/export.zip', methods=['GET'])
+@jwt_required()
+def export_beats_zip():
+    user_id = int(get_jwt_identity())
+    try:
+        ids = [int(beat_id) for beat_id in request.args.get('ids', '').split(',') if beat_id]
+    except ValueError:
+        return jsonify({'message': 'ids must be a comma separated list of beat ids'}), 400
+    if not ids:
+        return jsonify({'message': 'ids is required'}), 400
+
+    def files():
+        for start in range(0, len(ids), 50):
+            beats = Beat.query.filter(Beat.id.in_(ids[start:start + 50]), Beat.user_id == user_id).all()
+            for beat in beats:
+                try:
+                    groove, _ = _playback_groove(beat)
+                    _, data = beat_to_midi(beat.beat_schema, beat.bpm, groove)
+                except ValueError:
+                    continue
+                yield f'{beat.id}-{secure_filename(beat.beat_name) or "beat"}.mid', data
+
+    return Response(stream_with_context(stream_zip(files())), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=beats.zip'})
+
+
 @app.route('/beats/<int:id>', methods=['PUT'])
 def update_beat(id):
     beat = Beat.query.get_or_404(id)
@@ -159,10 +492,250 @@ def update_beat(id):
     beat.genre = data.get("genre", beat.genre)
     beat.beat_schema = data.get("beat_schema", beat.beat_schema)
     beat.bpm = data.get("bpm", beat.bpm)
+    groove_id = data.get("groove_id", beat.groove_id)
+    if groove_id is not None and groove_id != beat.groove_id and not _owned_groove(groove_id, beat.user_id):
+        return jsonify({'message': 'Groove not found'}), 404
+    beat.groove_id = groove_id
+    beat.version = Beat.version + 1
     db.session.commit()
     return jsonify({"message": "Beat updated successfully!"})
 
 
+# edits single cells of a beat grid: {"version": 3, "cells": [["kick", 0, 2, 1], ...]}
+@app.route('/beats/<int:id>', methods=['PATCH'])
+@jwt_required()
+def patch_beat(id):
+    # only the owner is loaded, not the grid
+    beat = Beat.query.with_entities(Beat.user_id).filter_by(id=id).first()
+    if not beat:
+        return jsonify({'message': 'Beat not found'}), 404
+    if beat.user_id != int(get_jwt_identity()):
+        return jsonify({'message': 'You are not allowed to edit this beat'}), 403
+
+    try:
+        data = beat_patch_schema.load(request.get_json())
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+
+    try:
+        version = patch_cells(id, data['cells'], expected_version=data['version'])
+    except VersionConflict as err:
+        return jsonify({'message': str(err)}), 409
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+    return jsonify({'message': 'Beat updated successfully!', 'version': version})
+
+
+def _transformed_beats(beats, data, user_id):
+    try:
+        schemas = transform_schemas([beat.beat_schema for beat in beats], data['transforms'])
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+
+    suffix = '+'.join(transform['op'] for transform in data['transforms'])
+    results = [{'source_id': beat.id, 'beat_name': f'{beat.beat_name} ({suffix})'[:50], 'genre': beat.genre,
+                'bpm': beat.bpm, 'beat_schema': schema, 'user_id': user_id}
+               for beat, schema in zip(beats, schemas)]
+    if data['save']:
+        new_beats = [Beat(**{k: v for k, v in result.items() if k != 'source_id'}) for result in results]
+        db.session.add_all(new_beats)
+        db.session.commit()
+        for result, new_beat in zip(results, new_beats):
+            result['id'] = new_beat.id
+    return jsonify(results), 200
+
+
+# double/half time, rotate, mirror, mute, quantize and humanize a stored beat, as a preview or saved as a new beat
+@app.route('/beats/<int:id>/transform', methods=['POST'])
+@jwt_required()
+def transform_beat(id):
+    beat = Beat.query.get(id)
+    if not beat:
+        return jsonify({'message': 'Beat not found'}), 404
+    try:
+        data = beat_transform_schema.load(request.get_json())
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+    return _transformed_beats([beat], data, int(get_jwt_identity()))
+
+
+# the same transforms over many of the current user's beats in one request
+@app.route('/beats/transform', methods=['POST'])
+@jwt_required()
+def transform_beats():
+    user_id = int(get_jwt_identity())
+    try:
+        data = batch_transform_schema.load(request.get_json())
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+    beats = Beat.query.filter(Beat.id.in_(data['ids']), Beat.user_id == user_id).order_by(Beat.id).all()
+    return _transformed_beats(beats, data, user_id)
+
+
+# queues an audio render of a beat; a job for identical content is reused instead of rendering twice
+@app.route('/beats/<int:id>/render-jobs', methods=['POST'])
+@jwt_required()
+def create_render_job(id):
+    beat = Beat.query.get(id)
+    if not beat:
+        return jsonify({'message': 'Beat not found'}), 404
+    try:
+        options = render_options_schema.load(request.get_json(silent=True) or {})
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+
+    kit, error = _render_kit(options.pop('kit_id'))
+    if error:
+        return error
+    groove, error = _playback_groove(beat, options.pop('groove_id'))
+    if error:
+        return error
+    if groove:
+        options['groove'] = groove
+    job, created = enqueue_render(beat, int(get_jwt_identity()), options, app.config['RENDER_DIR'], kit)
+    return jsonify(job.to_dict()), 202 if created else 200
+
+
+@app.route('/render-jobs/<int:id>', methods=['GET'])
+@jwt_required()
+def get_render_job(id):
+    job = RenderJob.query.get(id)
+    if not job:
+        return jsonify({'message': 'Render job not found'}), 404
+    if job.user_id != int(get_jwt_identity()):
+        return jsonify({'message': 'You are not allowed to view this job'}), 403
+    return jsonify(job.to_dict())
+
+
+@app.route('/render-jobs/<int:id>', methods=['DELETE'])
+@jwt_required()
+def delete_render_job(id):
+    job = RenderJob.query.get(id)
+    if not job:
+        return jsonify({'message': 'Render job not found'}), 404
+    if job.user_id != int(get_jwt_identity()):
+        return jsonify({'message': 'You are not allowed to cancel this job'}), 403
+    if not cancel_render(job):
+        return jsonify({'message': f'Render job {id} is already {job.status}'}), 409
+    return jsonify({'message': f'Render job {id} cancelled'})
+
+
+@app.route('/render-jobs/<int:id>/audio', methods=['GET'])
+@jwt_required()
+def get_render_audio(id):
+    job = RenderJob.query.get(id)
+    if not job:
+        return jsonify({'message': 'Render job not found'}), 404
+    if job.user_id != int(get_jwt_identity()):
+        return jsonify({'message': 'You are not allowed to view this job'}), 403
+    path = render_path(app.config['RENDER_DIR'], job.content_hash)
+    if job.status != 'done' or not os.path.exists(path):
+        return jsonify({'message': f'Render job {id} is {job.status}'}), 409
+    return send_file(path, mimetype='audio/wav', etag=job.content_hash)
+
+
+# server-sent change notifications for the current user's beats, texts, pages and blocks.
+# EventSource cannot set headers, so the token may also come as ?jwt=; Last-Event-ID resumes after a reconnect.
+@app.route('/events', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def get_events():
+    user_id = int(get_jwt_identity())
+    last_seq = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_seq = int(last_seq) if last_seq is not None else None
+    except ValueError:
+        return jsonify({'message': 'Last-Event-ID must be an event id'}), 400
+    return Response(stream_events(db.engine, user_id, last_seq), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# uploads a kit as multipart form data: a `name` and one PCM WAV file per instrument (kick, snare, high-hat,
+# tom1, tom2). Files are decoded in chunks and preprocessed once into the sample bank.
+@app.route('/kits', methods=['POST'])
+@jwt_required()
+def add_kit():
+    request.max_content_length = MAX_KIT_UPLOAD
+    user_id = int(get_jwt_identity())
+    name = request.form.get('name', '').strip()
+    if not 1 <= len(name) <= 50:
+        return jsonify({'message': 'name is required and at most 50 characters'}), 400
+    missing = [instrument for instrument in INSTRUMENTS if instrument not in request.files]
+    if missing:
+        return jsonify({'message': f'missing samples for: {missing}'}), 400
+
+    try:
+        sources = {}
+        for instrument in INSTRUMENTS:
+            try:
+                sources[instrument] = read_wav(request.files[instrument].stream)
+            except ValueError as err:
+                raise ValueError(f'{instrument}: {err}') from None
+        kit, created = create_kit(user_id, name, sources, app.config['SAMPLE_BANK_DIR'])
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+    return jsonify(kit.to_dict()), 201 if created else 200
+
+
+@app.route('/kits', methods=['GET'])
+@jwt_required()
+def get_kits():
+    user_id = int(get_jwt_identity())
+    kits = Kit.query.filter_by(user_id=user_id).all()
+    return jsonify([kit.to_dict() for kit in kits])
+
+
+@app.route('/grooves', methods=['POST'])
+@jwt_required()
+def add_groove():
+    try:
+        data = groove_schema.load(request.get_json())
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+
+    groove = GrooveTemplate(user_id=int(get_jwt_identity()), **data)
+    db.session.add(groove)
+    db.session.commit()
+    return jsonify(groove.to_dict()), 201
+
+
+@app.route('/grooves', methods=['GET'])
+@jwt_required()
+def get_grooves():
+    user_id = int(get_jwt_identity())
+    grooves = GrooveTemplate.query.filter_by(user_id=user_id).all()
+    return jsonify([groove.to_dict() for groove in grooves])
+
+
+@app.route('/grooves/<int:id>', methods=['GET'])
+@jwt_required()
+def get_groove_by_id(id):
+    groove = _owned_groove(id, int(get_jwt_identity()))
+    if not groove:
+        return jsonify({'message': 'Groove not found'}), 404
+    return jsonify(groove.to_dict())
+
+
+# edits a template in place; the new version changes the cache keys of everything played with it
+@app.route('/grooves/<int:id>', methods=['PUT'])
+@jwt_required()
+def update_groove(id):
+    groove = GrooveTemplate.query.get(id)
+    if not groove:
+        return jsonify({'message': 'Groove not found'}), 404
+    if groove.user_id != int(get_jwt_identity()):
+        return jsonify({'message': 'You are not allowed to edit this groove'}), 403
+    try:
+        data = groove_schema.load(request.get_json(), partial=True)
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
+
+    for key, value in data.items():
+        setattr(groove, key, value)
+    groove.version = GrooveTemplate.version + 1
+    db.session.commit()
+    return jsonify(groove.to_dict())
+
+
 @app.route('/texts', methods=['GET'])
 @jwt_required()
 def get_texts():
@@ -198,6 +771,50 @@ def get_text_by_id(id):
     return text_schema.dump(text), 200
 
 
+@app.route('/search', methods=['GET'])
+@jwt_required()
+def search_content():
+    user_id = int(get_jwt_identity())
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'message': 'q is required'}), 400
+    limit = request.args.get('limit', 20, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if not 1 <= limit <= MAX_SEARCH_LIMIT or offset < 0:
+        return jsonify({'message': f'limit must be between 1 and {MAX_SEARCH_LIMIT} and offset not negative'}), 400
+
+    results = search(user_id, query, limit=limit, offset=offset)
+    return jsonify({'query': query, 'limit': limit, 'offset': offset, 'results': results})
+
+
+# the caller's beats whose grid has a rhythm fragment anywhere in one instrument's row, across bar lines,
+# e.g. ?instrument=kick&pattern=1,0,0,1,0,0,1,0 (any non-zero step is a hit)
+@app.route('/beats/rhythm', methods=['GET'])
+@jwt_required()
+def search_rhythm():
+    user_id = int(get_jwt_identity())
+    instrument = request.args.get('instrument')
+    if instrument not in INSTRUMENTS:
+        return jsonify({'message': f'instrument must be one of: {INSTRUMENTS}'}), 400
+    try:
+        fragment = [int(step) for step in request.args.get('pattern', '').split(',')]
+    except ValueError:
+        return jsonify({'message': 'pattern must be comma-separated step values, e.g. 1,0,0,1'}), 400
+    if not 1 <= len(fragment) <= MAX_FRAGMENT or not any(fragment):
+        return jsonify({'message': f'pattern needs 1 to {MAX_FRAGMENT} steps and at least one hit'}), 400
+    limit = request.args.get('limit', 20, type=int)
+    if not 1 <= limit <= 100:
+        return jsonify({'message': 'limit must be between 1 and 100'}), 400
+
+    pattern_ids = db.session.scalars(db.select(Beat.pattern_id).where(Beat.user_id == user_id).distinct()).all()
+    matches, _ = find_patterns(db.session.connection(), instrument, fragment,
+                               pattern_ids=[pattern_id for pattern_id in pattern_ids if pattern_id is not None],
+                               limit=limit)
+    beats = (Beat.query.filter(Beat.user_id == user_id, Beat.pattern_id.in_(matches))
+             .order_by(Beat.id).limit(limit).all()) if matches else []
+    return jsonify({'instrument': instrument, 'pattern': fragment, 'beats': [beat_schema.dump(beat) for beat in beats]})
+
+
 @app.route('/pages', methods=['GET'])
 @jwt_required()
 def get_pages():
@@ -242,15 +859,55 @@ def add_page_blocks():
     new_page_block = PageBlock(
         block_type=data["block_type"],
         block_id=data["block_id"],
-        position=data["position"],
+        position=data.get("position"),
         page_id=data["page_id"]
     )
 
+    # without an explicit position the block goes after `after_id` (null for the top) or at the end
+    needs_rebalance = False
+    try:
+        if "after_id" in data:
+            needs_rebalance = place_block(new_page_block, data["after_id"])
+        elif new_page_block.position is None:
+            new_page_block.position = append_position(new_page_block.page_id)
+    except LookupError as err:
+        return jsonify({'message': str(err)}), 400
+
     db.session.add(new_page_block)
     db.session.commit()
+    if needs_rebalance:
+        schedule_rebalance(new_page_block.page_id)
     return jsonify({'message': 'page_block added successfully'}), 200
 
 
+# moves a block right after another block of the same page (null moves it to the top)
+@app.route('/page_blocks/<int:block_id>/position', methods=['PUT'])
+@jwt_required()
+def move_page_block(block_id):
+    block = PageBlock.query.get(block_id)
+    if not block:
+        return {'error': 'PageBlock not found!'}, 404
+    page = Page.query.get(block.page_id)
+    if not page or page.user_id != int(get_jwt_identity()):
+        return jsonify({'message': 'You are not allowed to edit this page'}), 403
+
+    data = request.get_json() or {}
+    if "after_id" not in data:
+        return jsonify({'message': 'after_id is required'}), 400
+    if data["after_id"] == block_id:
+        return jsonify({'message': 'A block cannot be moved after itself'}), 400
+
+    try:
+        needs_rebalance = place_block(block, data["after_id"])
+    except LookupError as err:
+        return jsonify({'message': str(err)}), 400
+
+    db.session.commit()
+    if needs_rebalance:
+        schedule_rebalance(block.page_id)
+    return jsonify({'message': 'page_block moved successfully', 'position': block.position}), 200
+
+
 @app.route('/users/<int:user_id>', methods=['DELETE'])
 def delete_user(user_id):
     user = User.query.get(user_id)
@@ -318,12 +975,121 @@ def get_page_by_id(id):
             for block in page.blocks
         ]
     }
+    # ?resolve=true embeds block contents, loaded with one query per block type
+    if request.args.get('resolve', 'false').lower() == 'true':
+        response["blocks"], response["unresolved"] = resolve_blocks(page.blocks)
     return jsonify(response)
 
 
+# replaces the whole ordered block list of a page in one transaction
+@app.route('/pages/<int:id>/blocks', methods=['PUT'])
+@jwt_required()
+def replace_blocks(id):
+    page = Page.query.get(id)
+    if not page:
+        return {'error': 'Page not found!'}, 404
+    if page.user_id != int(get_jwt_identity()):
+        return jsonify({'message': 'You are not allowed to edit this page'}), 403
 
+    try:
+        items = page_block_items_schema.load(request.get_json())
+    except ValidationError as err:
+        return jsonify({'message': 'Validation error', 'error': err.messages}), 400
 
-
+    changes = replace_page_blocks(page, items)
+    return jsonify({'message': 'page blocks saved successfully', **changes}), 200
+
+
+# run from cron: deletes content of deleted users and blocks pointing at deleted content, in short batches
+@app.cli.command('gc-orphans')
+@click.option('--batch-size', default=500, help='Rows scanned per transaction.')
+@click.option('--max-batches', type=int, default=None, help='Batches per table before stopping; resumes next run.')
+def gc_orphans_command(batch_size, max_batches):
+    report = collect_orphans(batch_size=batch_size, max_batches=max_batches)
+    for task, result in report.items():
+        status = 'done' if result['finished'] else 'paused at checkpoint'
+        click.echo(f"{task}: removed {result['removed']} {result['ids']} ({status})")
+
+
+# compresses Text.content rows written before compression was enabled; safe to run while the app is serving
+@app.cli.command('compress-texts')
+@click.option('--batch-size', default=500, help='Rows rewritten per transaction.')
+@click.option('--pause', default=0.0, help='Seconds to sleep between batches.')
+def compress_texts_command(batch_size, pause):
+    total = 0
+    for count, last_id in backfill_compressed(db.session, Text.content, batch_size=batch_size):
+        total += count
+        click.echo(f'rewrote {count} texts up to id {last_id}')
+        time.sleep(pause)
+    click.echo(f'done, {total} texts rewritten')
+
+
+# fills the rhythmic feature columns of patterns stored before they existed
+@app.cli.command('backfill-features')
+@click.option('--batch-size', default=500, help='Patterns per worker batch and per transaction.')
+@click.option('--workers', type=int, default=None, help='Worker processes, defaults to the CPU count.')
+def backfill_features_command(batch_size, workers):
+    total = 0
+    for count in backfill_features(db.session, batch_size=batch_size, workers=workers):
+        total += count
+        click.echo(f'computed features for {total} patterns')
+    click.echo('done')
+
+
+# rehashes patterns edited by cell PATCHes and merges the ones whose grid already has a pattern
+@app.cli.command('compact-patterns')
+@click.option('--batch-size', default=500, help='Patterns per transaction.')
+def compact_patterns_command(batch_size):
+    total = moved = 0
+    for count, merged in compact_patterns(db.session, batch_size=batch_size):
+        total += count
+        moved += merged
+        click.echo(f'compacted {total} patterns')
+    click.echo(f'done, {moved} beats moved onto existing patterns')
+
+
+# rebuilds the rhythm n-gram index from every stored pattern
+@app.cli.command('rebuild-ngram-index')
+def rebuild_ngram_index_command():
+    total = 0
+    for count in rebuild_ngram_index(db.session.connection()):
+        total += count
+    db.session.commit()
+    click.echo(f'indexed {total} patterns')
+
+
+# compares the facet aggregate against a full GROUP BY over beat; --repair rebuilds it
+@app.cli.command('check-facets')
+@click.option('--repair', is_flag=True, help='Rebuild the aggregate when it has drifted.')
+def check_facets_command(repair):
+    drift = facet_drift(db.session)
+    for user_id, facet, value, stored, expected in drift:
+        click.echo(f'user {user_id} {facet}={value}: stored {stored}, expected {expected}')
+    if not drift:
+        click.echo('facet counts are consistent')
+    elif repair:
+        rebuild_facets(db.session.connection())
+        db.session.commit()
+        click.echo(f'rebuilt facet counts ({len(drift)} rows were off)')
+
+
+# deletes change events older than --keep-hours; clients further behind get a reset event and reload
+@app.cli.command('prune-events')
+@click.option('--keep-hours', default=24, help='Hours of change events kept for reconnecting clients.')
+def prune_events_command(keep_hours):
+    click.echo(f'deleted {prune_events(db.session, keep_hours)} change events')
+
+
+# processes queued render jobs in a pool of worker processes, outside the gunicorn request workers
+@app.cli.command('render-worker')
+@click.option('--concurrency', type=int, default=None, help='Renders at once, defaults to RENDER_CONCURRENCY.')
+@click.option('--poll-interval', default=1.0, help='Seconds between queue checks.')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty.')
+@click.option('--stale-after', default=STALE_AFTER, help='Seconds without progress before a running job is requeued.')
+def render_worker_command(concurrency, poll_interval, once, stale_after):
+    run_worker(app.config['RENDER_DIR'], app.config['SAMPLE_BANK_DIR'],
+               concurrency or app.config['RENDER_CONCURRENCY'], poll_interval=poll_interval, once=once, log=click.echo,
+               stale_after=stale_after)
 
 
 if __name__ == "__main__":
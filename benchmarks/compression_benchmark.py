@@ -0,0 +1,82 @@
+"""Compare Text.content stored raw against CompressedText: write and read cost, and database size.
+
+    python benchmarks/compression_benchmark.py --rows 100000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, select, insert
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import CompressedText  # noqa: E402
+
+VOCABULARY = ('the kick snare hi-hat tom groove bar beat count play slowly fill accent ghost note tempo metronome '
+              'quarter eighth sixteenth triplet rest hand foot left right practice repeat lesson until steady').split()
+
+
+def lesson_texts(rows, seed=1):
+    rng = random.Random(seed)
+    for _ in range(rows):
+        # most lesson texts are short, a long tail are full lesson write-ups up to the 5000 character limit
+        length = min(5000, int(rng.paretovariate(1.2) * 150))
+        words = []
+        while sum(len(word) + 1 for word in words) < length:
+            words.append(rng.choice(VOCABULARY))
+        yield ' '.join(words)[:length]
+
+
+def run(column_type, texts, path, repeat_reads):
+    engine = create_engine(f'sqlite:///{path}')
+    metadata = MetaData()
+    table = Table('text', metadata, Column('id', Integer, primary_key=True),
+                  Column('content', column_type, nullable=False), Column('user_id', Integer, nullable=False))
+    metadata.create_all(engine)
+
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        for start in range(0, len(texts), 5000):
+            connection.execute(insert(table), [{'content': content, 'user_id': 1}
+                                               for content in texts[start:start + 5000]])
+    write = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        scanned = connection.execute(select(table.c.content)).scalars().all()
+    scan = time.perf_counter() - started
+    assert scanned == texts
+
+    ids = random.Random(2).sample(range(1, len(texts) + 1), repeat_reads)
+    started = time.perf_counter()
+    with engine.connect() as connection:
+        for text_id in ids:
+            connection.execute(select(table.c.content).where(table.c.id == text_id)).scalar_one()
+    point = (time.perf_counter() - started) / repeat_reads
+
+    engine.dispose()
+    return write, scan, point, os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--point-reads', type=int, default=5000)
+    args = parser.parse_args()
+
+    texts = list(lesson_texts(args.rows))
+    raw_bytes = sum(len(content.encode()) for content in texts)
+    print(f'{args.rows} texts, {raw_bytes / 2 ** 20:.1f} MiB of content')
+    print(f'{"column":<16} {"write s":>8} {"scan s":>8} {"point us":>9} {"size MiB":>9}')
+    with tempfile.TemporaryDirectory() as directory:
+        for name, column_type in (('String', String), ('CompressedText', CompressedText)):
+            write, scan, point, size = run(column_type, texts, os.path.join(directory, f'{name}.db'),
+                                           args.point_reads)
+            print(f'{name:<16} {write:>8.2f} {scan:>8.2f} {point * 1e6:>9.1f} {size / 2 ** 20:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Compare rhythm fragment search through the n-gram index against decoding every stored grid.
+
+    python benchmarks/ngram_benchmark.py --rows 1000000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exercises import LEVELS, generate_candidates  # noqa: E402
+from grid import INSTRUMENTS, encode_grid, decode_grid  # noqa: E402
+from ngrams import rebuild_ngram_index, index_patterns, find_patterns  # noqa: E402
+
+# (instrument, steps) of the fragments searched for, each cut at random from a stored grid's row
+QUERIES = [('kick', 4), ('kick', 8), ('kick', 16), ('snare', 12), ('tom1', 6), ('kick', 32)]
+
+
+def build(path, rows):
+    rng = np.random.default_rng(1)
+    engine = create_engine(f'sqlite:///{path}')
+    with engine.begin() as connection:
+        connection.exec_driver_sql('PRAGMA journal_mode = WAL')
+        connection.exec_driver_sql('CREATE TABLE beat_pattern (id INTEGER PRIMARY KEY, grid_hash TEXT UNIQUE, '
+                                   'beat_schema JSON NOT NULL)')
+        connection.exec_driver_sql('CREATE TABLE pattern_ngram (ngram INTEGER, block INTEGER, bits BLOB NOT NULL, '
+                                   'PRIMARY KEY (ngram, block)) WITHOUT ROWID')
+        levels = list(LEVELS)
+        batch = 50000
+        for start in range(0, rows, batch):
+            count = min(batch, rows - start)
+            grids = generate_candidates(levels[start // batch % len(levels)], count, rng)
+            connection.exec_driver_sql('INSERT INTO beat_pattern (beat_schema) VALUES (?)',
+                                       [(json.dumps(encode_grid(grid)),) for grid in grids])
+
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        for _ in rebuild_ngram_index(connection):
+            pass
+    return engine, time.perf_counter() - started
+
+
+def pick_fragments(connection, rng):
+    fragments = []
+    for instrument, steps in QUERIES:
+        while True:
+            beat_schema = connection.exec_driver_sql('SELECT beat_schema FROM beat_pattern WHERE id = ?',
+                                                     (int(rng.integers(1, 10000)),)).scalar()
+            row = (decode_grid(json.loads(beat_schema))[INSTRUMENTS.index(instrument)].ravel() > 0).astype(int)
+            start = int(rng.integers(0, len(row) - steps + 1))
+            if row[start:start + steps].any():
+                fragments.append((instrument, row[start:start + steps].tolist()))
+                break
+    return fragments
+
+
+def scan(connection, instrument, fragment):
+    hits = np.asarray(fragment) > 0
+    matches = []
+    for pattern_id, beat_schema in connection.exec_driver_sql('SELECT id, beat_schema FROM beat_pattern'):
+        row = decode_grid(json.loads(beat_schema))[INSTRUMENTS.index(instrument)].ravel() > 0
+        windows = np.lib.stride_tricks.sliding_window_view(row, len(hits))
+        if (windows == hits).all(axis=1).any():
+            matches.append(pattern_id)
+    return matches
+
+
+def timed(function, repeat):
+    samples, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--adds', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'ngrams.db')
+        engine, index_seconds = build(path, args.rows)
+        with engine.connect() as connection:
+            postings = connection.exec_driver_sql('SELECT count(*), sum(length(bits)) FROM pattern_ngram').one()
+        print(f'{args.rows} patterns, index built in {index_seconds:.1f}s, {postings[0]} bitmap rows, '
+              f'{postings[1] / 2 ** 20:.0f} MiB of bitmaps, db size {os.path.getsize(path) / 2 ** 20:.0f} MiB')
+
+        rng = np.random.default_rng(2)
+        new_grids = generate_candidates('intermediate', args.adds, rng)
+        with engine.begin() as connection:
+            started = time.perf_counter()
+            for grid in new_grids:
+                schema = encode_grid(grid)
+                pattern_id = connection.exec_driver_sql('INSERT INTO beat_pattern (beat_schema) VALUES (?) RETURNING id',
+                                                        (json.dumps(schema),)).scalar()
+                index_patterns(connection, [(pattern_id, schema)])
+            add_ms = (time.perf_counter() - started) / args.adds * 1000
+        print(f'incremental add: {add_ms:.2f} ms per pattern')
+
+        print(f'{"instrument":<10} {"steps":>5} {"matches":>8} {"checked":>8} {"first 20 ms":>12} {"all ms":>9}')
+        with engine.connect() as connection:
+            fragments = pick_fragments(connection, rng)
+            for instrument, fragment in fragments:
+                first_ms, _ = timed(lambda: find_patterns(connection, instrument, fragment, limit=20), args.repeat)
+                all_ms, (matches, checked) = timed(lambda: find_patterns(connection, instrument, fragment), 1)
+                print(f'{instrument:<10} {len(fragment):>5} {len(matches):>8} {checked:>8} {first_ms:>12.2f} {all_ms:>9.1f}')
+
+            instrument, fragment = fragments[1]
+            started = time.perf_counter()
+            scanned = scan(connection, instrument, fragment)
+            print(f'full scan and decode of every grid: {time.perf_counter() - started:.1f}s')
+            assert scanned == find_patterns(connection, instrument, fragment)[0]
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compare GET /search's FTS5 query against a naive LIKE scan.
+
+    python benchmarks/search_benchmark.py --rows 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search import SEARCH_INDEXES, search_ddl, build_match  # noqa: E402
+from compression import decompress_text  # noqa: E402
+
+_rng = random.Random(0)
+WORDS = [''.join(_rng.choices('abcdefghijklmnopqrstuvwxyz', k=_rng.randint(3, 9))) for _ in range(20000)]
+
+FTS_SQL = """
+    SELECT rowid, bm25(text_fts, 1.0, 0.0) AS score FROM text_fts
+    WHERE text_fts MATCH 'user_id : "' || ? || '" AND content : (' || ? || ')'
+    ORDER BY score LIMIT 20
+"""
+LIKE_SQL = "SELECT id FROM text WHERE user_id = ? AND content LIKE ? LIMIT 20"
+
+
+def build(path, rows, users):
+    rng = random.Random(1)
+    connection = sqlite3.connect(path)
+    connection.create_function('plain_text', 1, decompress_text, deterministic=True)
+    connection.executescript("""
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE text (id INTEGER PRIMARY KEY, content VARCHAR NOT NULL, user_id INTEGER NOT NULL);
+        CREATE TABLE beat (id INTEGER PRIMARY KEY, beat_name VARCHAR, genre VARCHAR, user_id INTEGER);
+        CREATE TABLE page (id INTEGER PRIMARY KEY, title VARCHAR, user_id INTEGER);
+    """)
+    # Zipf-ish vocabulary so some words are common and some rare, like real lesson texts
+    weights = [1 / (rank + 1) for rank in range(len(WORDS))]
+    batch = 50000
+    for start in range(0, rows, batch):
+        count = min(batch, rows - start)
+        words = rng.choices(WORDS, weights=weights, k=count * 40)
+        connection.executemany("INSERT INTO text (content, user_id) VALUES (?, ?)",
+                               ((' '.join(words[i * 40:(i + 1) * 40]), rng.randint(1, users)) for i in range(count)))
+    connection.commit()
+
+    started = time.perf_counter()
+    for statement in search_ddl():
+        connection.execute(statement)
+    for fts in SEARCH_INDEXES:
+        connection.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+    connection.commit()
+    return connection, time.perf_counter() - started
+
+
+def timed(connection, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        connection.execute(sql, params).fetchall()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'search.db')
+        connection, index_seconds = build(path, args.rows, args.users)
+        print(f'{args.rows} texts, {args.users} users, index built in {index_seconds:.1f}s, '
+              f'db size {os.path.getsize(path) / 2 ** 20:.0f} MiB')
+        print(f'{"term":<12} {"fts5 ms":>10} {"like ms":>10}')
+        for rank in (5, 500, 15000):
+            term = WORDS[rank]
+            fts = timed(connection, FTS_SQL, (7, build_match(term)), args.repeat)
+            like = timed(connection, LIKE_SQL, (7, f'%{term}%'), args.repeat)
+            print(f'{term:<12} {fts:>10.2f} {like:>10.2f}')
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import threading
+from bisect import bisect_left
+from collections import namedtuple
+from flask import current_app
+from sqlalchemy import insert, update, delete, select, func
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, PageBlock, Text, Beat
+from events import record_change
+
+# positions are sparse ranks: a block placed between two neighbours takes the midpoint, touching only its own row
+POSITION_GAP = 1024
+# once a gap gets this small the page is respaced in the background, before an insert can run out of room
+REBALANCE_THRESHOLD = 4
+
+_pending_rebalances = set()
+_pending_lock = threading.Lock()
+
+# a loader takes a list of ids and returns {id: row} in one query; model is the table block_id points at, if any
+BlockResolver = namedtuple('BlockResolver', ['loader', 'serializer', 'model'])
+
+BLOCK_RESOLVERS = {}
+
+
+def register_block_type(block_type, loader, serializer, model=None):
+    BLOCK_RESOLVERS[block_type] = BlockResolver(loader, serializer, model)
+
+
+def model_loader(model):
+    def load(ids):
+        return {row.id: row for row in model.query.filter(model.id.in_(ids))}
+    return load
+
+
+register_block_type('text', model_loader(Text), Text.to_dict, Text)
+register_block_type('beat', model_loader(Beat), Beat.to_dict, Beat)
+
+
+# resolve the contents of many blocks with one query per block type
+def resolve_blocks(blocks):
+    ids_by_type = {}
+    for block in blocks:
+        ids_by_type.setdefault(block.block_type, set()).add(block.block_id)
+
+    loaded = {}
+    for block_type, ids in ids_by_type.items():
+        if block_type in BLOCK_RESOLVERS:
+            loaded[block_type] = BLOCK_RESOLVERS[block_type].loader(list(ids))
+
+    resolved, unresolved = [], []
+    for block in blocks:
+        entry = {"id": block.id, "block_id": block.block_id, "block_type": block.block_type,
+                 "position": block.position}
+        if block.block_type not in BLOCK_RESOLVERS:
+            unresolved.append({**entry, "reason": "unknown block type"})
+            continue
+        row = loaded[block.block_type].get(block.block_id)
+        if row is None:
+            unresolved.append({**entry, "reason": "missing content"})
+            continue
+        resolved.append({**entry, "content": BLOCK_RESOLVERS[block.block_type].serializer(row)})
+    return resolved, unresolved
+
+
+def rank_between(before, after):
+    if before is None and after is None:
+        return POSITION_GAP
+    if before is None:
+        return after - POSITION_GAP
+    if after is None:
+        return before + POSITION_GAP
+    if after - before < 2:
+        return None
+    return (before + after) // 2
+
+
+def _neighbour_positions(page_id, after_id, exclude_id=None):
+    blocks = select(PageBlock.position).where(PageBlock.page_id == page_id)
+    if exclude_id is not None:
+        blocks = blocks.where(PageBlock.id != exclude_id)
+
+    if after_id is None:
+        before = None
+    else:
+        before = db.session.scalar(select(PageBlock.position).where(PageBlock.id == after_id,
+                                                                    PageBlock.page_id == page_id))
+        if before is None:
+            raise LookupError(f'PageBlock {after_id} is not on page {page_id}')
+        blocks = blocks.where(PageBlock.position > before)
+
+    after = db.session.scalar(blocks.order_by(PageBlock.position).limit(1))
+    return before, after
+
+
+# place a block right after after_id (None puts it at the top); returns True when the page should be respaced
+def place_block(block, after_id):
+    before, after = _neighbour_positions(block.page_id, after_id, exclude_id=block.id)
+    position = rank_between(before, after)
+    if position is None:
+        rebalance_page(block.page_id)
+        if block.id is not None:
+            db.session.expire(block, ['position'])
+        before, after = _neighbour_positions(block.page_id, after_id, exclude_id=block.id)
+        position = rank_between(before, after)
+
+    block.position = position
+    gaps = [position - before if before is not None else POSITION_GAP,
+            after - position if after is not None else POSITION_GAP]
+    return min(gaps) <= REBALANCE_THRESHOLD
+
+
+def append_position(page_id):
+    last = db.session.scalar(select(func.max(PageBlock.position)).where(PageBlock.page_id == page_id))
+    return rank_between(last, None)
+
+
+# respace every block of a page POSITION_GAP apart, keeping their order
+def rebalance_page(page_id):
+    ids = db.session.scalars(select(PageBlock.id).where(PageBlock.page_id == page_id)
+                             .order_by(PageBlock.position, PageBlock.id)).all()
+    if ids:
+        db.session.execute(update(PageBlock), [{'id': block_id, 'position': (i + 1) * POSITION_GAP}
+                                               for i, block_id in enumerate(ids)])
+    return len(ids)
+
+
+# call after the placing transaction committed, so the rebalance sees the new order
+def schedule_rebalance(page_id):
+    with _pending_lock:
+        if page_id in _pending_rebalances:
+            return
+        _pending_rebalances.add(page_id)
+
+    app = current_app._get_current_object()
+
+    def run():
+        try:
+            with app.app_context():
+                try:
+                    rebalance_page(page_id)
+                    db.session.commit()
+                except SQLAlchemyError:
+                    # a concurrent write won; the next tight insert schedules another pass
+                    db.session.rollback()
+        finally:
+            with _pending_lock:
+                _pending_rebalances.discard(page_id)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _longest_increasing(values):
+    # indexes of one longest strictly increasing subsequence
+    tails, tail_idx, parent = [], [], [None] * len(values)
+    for i, value in enumerate(values):
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tail_idx.append(i)
+        else:
+            tails[k] = value
+            tail_idx[k] = i
+        parent[i] = tail_idx[k - 1] if k else None
+
+    result, i = [], tail_idx[-1] if tail_idx else None
+    while i is not None:
+        result.append(i)
+        i = parent[i]
+    return result[::-1]
+
+
+# keep the positions of the largest set of rows that stay in order and rank the rest between them
+def _assign_positions(matched):
+    positions = [None] * len(matched)
+    seq = [i for i, block in enumerate(matched) if block is not None]
+    for k in _longest_increasing([matched[i].position for i in seq]):
+        positions[seq[k]] = matched[seq[k]].position
+
+    i = 0
+    while i < len(positions):
+        if positions[i] is not None:
+            i += 1
+            continue
+        j = i
+        while j < len(positions) and positions[j] is None:
+            j += 1
+        lo = positions[i - 1] if i else None
+        hi = positions[j] if j < len(positions) else None
+        run = j - i
+        if lo is None and hi is None:
+            lo, hi = 0, (run + 1) * POSITION_GAP
+        elif lo is None:
+            lo = hi - (run + 1) * POSITION_GAP
+        elif hi is None:
+            hi = lo + (run + 1) * POSITION_GAP
+        step = (hi - lo) // (run + 1)
+        if step < 1:
+            # no room left between the kept rows, respace the whole page instead
+            return [(n + 1) * POSITION_GAP for n in range(len(matched))]
+        for n in range(run):
+            positions[i + n] = lo + step * (n + 1)
+        i = j
+    return positions
+
+
+# diff the submitted, ordered block list against the rows a page already has
+def diff_page_blocks(existing, items):
+    by_id = {block.id: block for block in existing}
+    # rows without an explicit id can still reuse an unclaimed row pointing at the same content
+    claimed = {item['id'] for item in items if item.get('id') in by_id}
+    by_content = {}
+    for block in sorted(existing, key=lambda b: b.position):
+        if block.id not in claimed:
+            by_content.setdefault((block.block_type, block.block_id), []).append(block)
+
+    matched = []
+    for item in items:
+        block = by_id.get(item.get('id'))
+        key = (item['block_type'], item['block_id'])
+        if block is None and by_content.get(key):
+            block = by_content[key].pop(0)
+        matched.append(block)
+
+    inserts, updates, kept = [], [], set()
+    for item, block, position in zip(items, matched, _assign_positions(matched)):
+        row = {'block_type': item['block_type'], 'block_id': item['block_id'], 'position': position}
+        if block is None:
+            inserts.append(row)
+            continue
+
+        kept.add(block.id)
+        if (block.block_type, block.block_id, block.position) != (row['block_type'], row['block_id'], position):
+            updates.append({'id': block.id, **row})
+
+    deletes = [block.id for block in existing if block.id not in kept]
+    return inserts, updates, deletes
+
+
+# replace all blocks of a page with one statement per kind of change and a single commit
+def replace_page_blocks(page, items):
+    existing = PageBlock.query.filter_by(page_id=page.id).all()
+    inserts, updates, deletes = diff_page_blocks(existing, items)
+
+    if deletes:
+        db.session.execute(delete(PageBlock).where(PageBlock.id.in_(deletes)))
+    if updates:
+        db.session.execute(update(PageBlock), updates)
+    created = []
+    if inserts:
+        created = db.session.scalars(insert(PageBlock).returning(PageBlock.id, sort_by_parameter_order=True),
+                                     [{**row, 'page_id': page.id} for row in inserts]).all()
+    for action, ids in (('created', created), ('deleted', deletes), ('updated', [row['id'] for row in updates])):
+        for block_id in ids:
+            record_change(db.session, 'page_block', block_id, action, page.user_id, page_id=page.id)
+    record_change(db.session, 'page', page.id, 'updated', page.user_id)
+    db.session.commit()
+
+    return {'inserted': len(inserts), 'updated': len(updates), 'deleted': len(deletes)}
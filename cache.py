@@ -0,0 +1,35 @@
+import threading
+from collections import OrderedDict
+
+
+# small thread-safe LRU for derived artifacts keyed by content hash, one per worker process
+class LRUCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def get_or_create(self, key, factory):
+        value = self.get(key)
+        if value is None:
+            value = self.set(key, factory())
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
@@ -0,0 +1,67 @@
+import json
+import uuid
+from sqlalchemy import text
+from models import db, PENDING_HASH
+from events import record_change
+from features import FEATURE_COLUMNS
+
+# SQLite functions take at most 127 arguments, so json_set calls are nested in chunks of this many cells
+CELLS_PER_JSON_SET = 60
+
+
+class VersionConflict(Exception):
+    pass
+
+
+def _cell_path(instrument, bar, step):
+    return f'$.{json.dumps(instrument)}[{bar}][{step}]'
+
+
+# apply (instrument, bar, step, value) edits to a beat's grid; returns the new version.
+# Only the edited cells are checked and written, the grid itself never goes through Python: a pattern only
+# this beat uses is edited in place, a shared one is first copied to a pattern of the beat's own. Either way
+# the pattern gets a fresh pending grid_hash and is rehashed and deduplicated later by compact_patterns.
+def patch_cells(beat_id, cells, expected_version=None):
+    cells = list({(instrument, bar, step): value for instrument, bar, step, value in cells}.items())
+    params = {'id': beat_id, 'hash': PENDING_HASH + uuid.uuid4().hex}
+    for i, ((instrument, bar, step), value) in enumerate(cells):
+        params[f'p{i}'], params[f'v{i}'] = _cell_path(instrument, bar, step), value
+
+    checks = ', '.join(f'json_type(p.beat_schema, :p{i})' for i in range(len(cells)))
+    row = db.session.execute(text(
+        f'SELECT b.version, b.user_id, p.id, p.ref_count, {checks} FROM beat b '
+        f'JOIN beat_pattern p ON p.id = b.pattern_id WHERE b.id = :id'), params).first()
+    if row is None:
+        raise LookupError(f'Beat {beat_id} not found')
+    version, user_id, params['pattern_id'], ref_count, types = row[0], row[1], row[2], row[3], row[4:]
+    if expected_version is not None and expected_version != version:
+        raise VersionConflict(f'Beat {beat_id} is at version {version}, not {expected_version}')
+    missing = [list(cell) for (cell, _), kind in zip(cells, types) if kind != 'integer']
+    if missing:
+        raise ValueError(f'cells outside the beat grid: {missing}')
+
+    expression = 'beat_schema'
+    for start in range(0, len(cells), CELLS_PER_JSON_SET):
+        pairs = ', '.join(f':p{i}, :v{i}' for i in range(start, min(start + CELLS_PER_JSON_SET, len(cells))))
+        expression = f'json_set({expression}, {pairs})'
+    if ref_count > 1:
+        # features are carried over until compaction recomputes them
+        columns = ', '.join(FEATURE_COLUMNS + ['undecodable'])
+        params['pattern_id'] = db.session.execute(text(
+            f'INSERT INTO beat_pattern (grid_hash, beat_schema, ref_count, {columns}) '
+            f'SELECT :hash, {expression}, 0, {columns} FROM beat_pattern WHERE id = :pattern_id RETURNING id'),
+            params).scalar()
+    else:
+        db.session.execute(text(
+            f'UPDATE beat_pattern SET beat_schema = {expression}, grid_hash = :hash WHERE id = :pattern_id'), params)
+
+    params['version'] = version
+    new_version = db.session.execute(text(
+        'UPDATE beat SET pattern_id = :pattern_id, version = version + 1 '
+        'WHERE id = :id AND version = :version RETURNING version'), params).scalar()
+    if new_version is None:
+        db.session.rollback()
+        raise VersionConflict(f'Beat {beat_id} changed while it was being patched')
+    record_change(db.session, 'beat', beat_id, 'updated', user_id)
+    db.session.commit()
+    return new_version
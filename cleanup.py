@@ -0,0 +1,85 @@
+from sqlalchemy import select, delete, exists, or_, and_
+from models import (db, User, Beat, Text, Page, PageBlock, GcCheckpoint, PracticeAttempt, PracticeProgress,
+                    GrooveTemplate, RenderJob, Kit)
+from practice import ALL_BEATS
+from blocks import BLOCK_RESOLVERS
+
+
+def _owner_missing(model):
+    return ~exists().where(User.id == model.user_id)
+
+
+def _block_dangling():
+    conditions = [~exists().where(Page.id == PageBlock.page_id)]
+    for block_type, resolver in BLOCK_RESOLVERS.items():
+        if resolver.model is not None:
+            conditions.append(and_(PageBlock.block_type == block_type,
+                                   ~exists().where(resolver.model.id == PageBlock.block_id)))
+    return or_(*conditions)
+
+
+def _beat_missing(model):
+    return ~exists().where(Beat.id == model.beat_id)
+
+
+# content goes first, so blocks, attempts and progress pointing at it are collected in the same run.
+# Tasks are (name, model, orphaned) or, for tables without an id, (name, model, orphaned, scan column).
+def gc_tasks():
+    return [
+        ('page', Page, _owner_missing(Page)),
+        ('text', Text, _owner_missing(Text)),
+        ('beat', Beat, _owner_missing(Beat)),
+        ('practice_attempt', PracticeAttempt, or_(_owner_missing(PracticeAttempt), _beat_missing(PracticeAttempt))),
+        ('practice_progress', PracticeProgress,
+         or_(_owner_missing(PracticeProgress),
+             and_(PracticeProgress.beat_id != ALL_BEATS, _beat_missing(PracticeProgress))),
+         PracticeProgress.user_id),
+        # a template still played by some beat is kept
+        ('groove_template', GrooveTemplate,
+         and_(_owner_missing(GrooveTemplate), ~exists().where(Beat.groove_id == GrooveTemplate.id))),
+        ('render_job', RenderJob, _owner_missing(RenderJob)),
+        ('kit', Kit, _owner_missing(Kit)),
+        ('page_block', PageBlock, _block_dangling()),
+    ]
+
+
+def _checkpoint(task):
+    checkpoint = db.session.get(GcCheckpoint, task)
+    if checkpoint is None:
+        checkpoint = GcCheckpoint(task=task, last_id=0)
+        db.session.add(checkpoint)
+    return checkpoint
+
+
+# scan the next batch_size ids after the checkpoint and delete the orphans among them in one short transaction.
+# `key` is the column scanned in order, the id unless the table has none.
+def collect_batch(task, model, orphaned, batch_size, key=None):
+    key = model.id if key is None else key
+    checkpoint = _checkpoint(task)
+    window_end = db.session.scalar(select(key).where(key > checkpoint.last_id)
+                                   .order_by(key).offset(batch_size - 1).limit(1))
+    window = key > checkpoint.last_id
+    if window_end is not None:
+        window = and_(window, key <= window_end)
+
+    ids = db.session.scalars(select(key).where(window, orphaned).distinct()).all()
+    if ids:
+        db.session.execute(delete(model).where(key.in_(ids), orphaned).execution_options(synchronize_session=False))
+
+    # the last window wraps the checkpoint around, so the next pass catches rows orphaned since
+    finished = window_end is None
+    checkpoint.last_id = 0 if finished else window_end
+    db.session.commit()
+    return ids, finished
+
+
+def collect_orphans(batch_size=500, max_batches=None):
+    report = {}
+    for task, model, orphaned, *key in gc_tasks():
+        removed, batches, finished = [], 0, False
+        while not finished and (max_batches is None or batches < max_batches):
+            ids, finished = collect_batch(task, model, orphaned, batch_size, *key)
+            removed.extend(ids)
+            batches += 1
+        report[task] = {'removed': len(removed), 'ids': removed, 'finished': finished}
+    return report
@@ -0,0 +1,71 @@
+import sqlite3
+import zlib
+from sqlalchemy import event, String, LargeBinary, select, update, func, cast
+from sqlalchemy.engine import Engine
+from sqlalchemy.types import TypeDecorator
+
+# compressed values are stored as a BLOB starting with this format tag; plain TEXT values are raw,
+# which is also how every row written before compression existed looks
+ZLIB_TAG = b'\x01'
+COMPRESS_THRESHOLD = 512
+
+
+def compress_text(value, threshold=COMPRESS_THRESHOLD, level=6):
+    if value is None:
+        return None
+    raw = value.encode('utf-8')
+    if len(raw) < threshold:
+        return value
+    packed = ZLIB_TAG + zlib.compress(raw, level)
+    return packed if len(packed) < len(raw) else value
+
+
+def decompress_text(value):
+    if isinstance(value, bytes):
+        if value[:1] != ZLIB_TAG:
+            raise ValueError(f'unknown compressed text format {value[:1]!r}')
+        return zlib.decompress(value[1:]).decode('utf-8')
+    return value
+
+
+# a String column that zlib-compresses values of at least `threshold` bytes
+class CompressedText(TypeDecorator):
+    impl = String
+    cache_ok = True
+
+    def __init__(self, *args, threshold=COMPRESS_THRESHOLD, level=6, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+        self.level = level
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value, self.threshold, self.level)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+
+# lets SQL that sees stored values (the search triggers and index) read compressed text as plain text
+@event.listens_for(Engine, 'connect')
+def register_sqlite_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('plain_text', 1, decompress_text, deterministic=True)
+
+
+# rewrite raw rows of a CompressedText column in id order, one short transaction per batch; yields per-batch counts
+def backfill_compressed(session, attribute, batch_size=500):
+    model, threshold = attribute.class_, attribute.type.threshold
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(model.id, attribute)
+            .where(model.id > last_id, func.typeof(attribute) == 'text',
+                   func.length(cast(attribute, LargeBinary)) >= threshold)
+            .order_by(model.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        session.execute(update(model), [{'id': row_id, attribute.key: value} for row_id, value in rows])
+        session.commit()
+        last_id = rows[-1][0]
+        yield len(rows), last_id
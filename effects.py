@@ -0,0 +1,118 @@
+import functools
+import numpy as np
+from grid import INSTRUMENTS
+
+# Per-render effects, all optional: {'gain': {instrument: dB}, 'pan': {instrument: -1..1}, 'eq': {...},
+# 'reverb': {...}, 'compressor': {...}}. EQ, gain and pan are linear and per instrument, so they are applied
+# to the short voices before they are placed on the timeline instead of to the whole mix. The stereo bus
+# then goes through the reverb and finally the bus compressor. Bus signals are (2, samples) arrays.
+EQ_LOW_HZ = 250
+EQ_HIGH_HZ = 4000
+COMPRESSOR_BLOCK = 128
+REVERB_SEED = 7
+
+
+# (instruments, 2) left/right multipliers; pan uses a balance law so a centred instrument keeps unity gain
+def channel_gains(effects):
+    effects = effects or {}
+    gain = np.array([10 ** ((effects.get('gain') or {}).get(instrument, 0.0) / 20) for instrument in INSTRUMENTS])
+    pan = np.array([(effects.get('pan') or {}).get(instrument, 0.0) for instrument in INSTRUMENTS])
+    return np.stack([np.minimum(1, 1 - pan), np.minimum(1, 1 + pan)], axis=1) * gain[:, None]
+
+
+# three bands split at EQ_LOW_HZ and EQ_HIGH_HZ, applied to a mono voice as one zero-phase gain curve
+def equalize(voice, rate, low_db=0.0, mid_db=0.0, high_db=0.0):
+    n = 1 << (len(voice) + 4096 - 1).bit_length()
+    freqs = np.fft.rfftfreq(n, 1 / rate)
+    low = 1 / (1 + (freqs / EQ_LOW_HZ) ** 2)
+    high = 1 / (1 + (EQ_HIGH_HZ / np.maximum(freqs, 1e-9)) ** 2)
+    mid = np.clip(1 - low - high, 0, 1)
+    curve = 10 ** ((low_db * low + mid_db * mid + high_db * high) / 20)
+    return np.fft.irfft(np.fft.rfft(voice, n) * curve, n)[:len(voice)]
+
+
+def shape_voices(voices, effects, rate):
+    if not (effects or {}).get('eq'):
+        return voices
+    return {instrument: equalize(voice, rate, **effects['eq']) for instrument, voice in voices.items()}
+
+
+# stereo-linked RMS compressor. Levels and gain reduction are computed per block of COMPRESSOR_BLOCK
+# samples; only the attack/release smoothing walks the blocks in order, then gains are interpolated per sample.
+def compress(signal, rate, threshold_db=-18.0, ratio=4.0, attack_ms=10.0, release_ms=120.0, makeup_db=0.0):
+    n = signal.shape[1]
+    blocks = -(-n // COMPRESSOR_BLOCK)
+    padded = np.zeros((2, blocks * COMPRESSOR_BLOCK))
+    padded[:, :n] = signal
+    level = np.sqrt((padded.reshape(2, blocks, -1) ** 2).mean(axis=(0, 2)))
+    over = np.maximum(20 * np.log10(np.maximum(level, 1e-9)) - threshold_db, 0)
+    target = -over * (1 - 1 / ratio)
+
+    attack = np.exp(-COMPRESSOR_BLOCK / (attack_ms / 1000 * rate))
+    release = np.exp(-COMPRESSOR_BLOCK / (release_ms / 1000 * rate))
+    smoothed, reduction = np.empty(blocks), 0.0
+    for i, goal in enumerate(target.tolist()):
+        coeff = attack if goal < reduction else release
+        reduction = coeff * reduction + (1 - coeff) * goal
+        smoothed[i] = reduction
+
+    centres = (np.arange(blocks) + 0.5) * COMPRESSOR_BLOCK
+    gain_db = np.interp(np.arange(n), centres, smoothed) + makeup_db
+    return signal * 10 ** (gain_db / 20)
+
+
+# decaying stereo noise reaching -60 dB after `decay` seconds, scaled to unit energy per channel
+def impulse_response(decay, rate):
+    t = np.arange(int(decay * rate)) / rate
+    noise = np.random.default_rng(REVERB_SEED).standard_normal((len(t), 2))
+    ir = noise * np.exp(-6.9 * t / decay)[:, None]
+    return ir / np.sqrt((ir ** 2).sum(axis=0))
+
+
+# (2, size // 2 + 1): one spectrum per channel, kept for the next render with the same reverb
+@functools.lru_cache(maxsize=16)
+def _kernel_spectrum(decay, rate, size):
+    return np.fft.rfft(impulse_response(decay, rate).T, size, axis=1)
+
+
+# FFT overlap-add convolution of a mono signal with a stereo impulse response: the signal is cut into
+# blocks at least as long as the response, all blocks are transformed in one batched rfft and their
+# outputs are summed back at the block hop. Returns (2, n), the input's length.
+def overlap_add(signal, decay, rate):
+    n, m = len(signal), int(decay * rate)
+    block = 1 << max(m - 1, 1).bit_length()
+    size = 2 * block
+    blocks = -(-n // block)
+    padded = np.zeros(blocks * block)
+    padded[:n] = signal
+    spectra = np.fft.rfft(padded.reshape(blocks, block), size)[None] * _kernel_spectrum(decay, rate, size)[:, None]
+    pieces = np.fft.irfft(spectra, size)
+    out = np.zeros((2, (blocks + 1) * block))
+    out[:, :blocks * block] += pieces[:, :, :block].reshape(2, -1)
+    out[:, block:] += pieces[:, :, block:].reshape(2, -1)
+    return out[:, :n]
+
+
+# A mono send of the bus through the reverb, mixed back in. The reverb runs at half the sample rate, which
+# keeps everything below 11 kHz of its tail (about what a room leaves of it anyway) for half the FFT work.
+def reverb(signal, rate, decay=1.2, mix=0.25):
+    n = signal.shape[1]
+    send = np.pad(signal[0] + signal[1], (0, n % 2)) * 0.25
+    low = overlap_add(send[0::2] + send[1::2], decay, rate // 2)
+    wet = np.empty((2, 2 * low.shape[1]))
+    wet[:, 0::2] = low
+    wet[:, 1::2] = (low + np.concatenate([low[:, 1:], low[:, -1:]], axis=1)) * 0.5
+    return signal * (1 - mix) + wet[:, :n] * mix
+
+
+def tail_samples(effects, rate):
+    reverb_options = (effects or {}).get('reverb')
+    return int(reverb_options['decay'] * rate) if reverb_options else 0
+
+
+def apply_bus(signal, effects, rate):
+    if effects.get('reverb'):
+        signal = reverb(signal, rate, **effects['reverb'])
+    if effects.get('compressor'):
+        signal = compress(signal, rate, **effects['compressor'])
+    return signal
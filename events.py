@@ -0,0 +1,183 @@
+import json
+import queue
+import threading
+from datetime import timedelta
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, insert, select, delete, func
+from models import Beat, Text, Page, PageBlock, ChangeEvent, utcnow
+
+# Committed changes are appended to change_event inside the committing transaction. Every process
+# tails that table by sequence number in one background thread and hands the events to its open
+# GET /events streams, so writes made by any gunicorn worker reach subscribers on all of them.
+TRACKED = {Beat: 'beat', Text: 'text', Page: 'page', PageBlock: 'page_block'}
+POLL_INTERVAL = 0.5
+KEEPALIVE = 15
+BACKLOG_LIMIT = 1000
+
+_events = ChangeEvent.__table__
+
+
+def _pending(session):
+    return session.info.setdefault('change_events', [])
+
+
+# for writes that bypass the unit of work (bulk insert/update/delete statements)
+def record_change(session, entity, entity_id, action, user_id, page_id=None):
+    _pending(session).append({'entity': entity, 'entity_id': entity_id, 'action': action,
+                              'user_id': user_id, 'page_id': page_id})
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed(session, flush_context):
+    changed = ([(obj, 'created') for obj in session.new] +
+               [(obj, 'updated') for obj in session.dirty if session.is_modified(obj, include_collections=False)] +
+               [(obj, 'deleted') for obj in session.deleted])
+    page_users = {obj.id: obj.user_id for obj, _ in changed if isinstance(obj, Page)}
+    for obj, action in changed:
+        entity = TRACKED.get(type(obj))
+        if entity is None:
+            continue
+        if entity == 'page_block':
+            record_change(session, entity, obj.id, action, page_users.get(obj.page_id), page_id=obj.page_id)
+        else:
+            record_change(session, entity, obj.id, action, obj.user_id)
+
+
+@event.listens_for(Session, 'before_commit')
+def _write_change_events(session):
+    session.flush()
+    rows = session.info.pop('change_events', None)
+    if not rows:
+        return
+    # blocks only know their page; look up the owners of pages that were not part of the flush
+    unknown = {row['page_id'] for row in rows if row['user_id'] is None}
+    if unknown:
+        owners = dict(session.execute(select(Page.id, Page.user_id).where(Page.id.in_(unknown))).all())
+        for row in rows:
+            if row['user_id'] is None:
+                row['user_id'] = owners.get(row['page_id'])
+    rows = [row for row in rows if row['user_id'] is not None]
+    if rows:
+        session.execute(insert(_events), rows)
+        session.info['wrote_change_events'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_local(session):
+    if session.info.pop('wrote_change_events', False):
+        broker.wake()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_pending(session, previous_transaction):
+    session.info.pop('change_events', None)
+    session.info.pop('wrote_change_events', None)
+
+
+def _payload(row):
+    payload = {'seq': row.seq, 'type': row.entity, 'id': row.entity_id, 'action': row.action}
+    if row.page_id is not None:
+        payload['page_id'] = row.page_id
+    return payload
+
+
+def _select_events(after):
+    return (select(_events.c.seq, _events.c.user_id, _events.c.entity, _events.c.entity_id, _events.c.action,
+                   _events.c.page_id).where(_events.c.seq > after).order_by(_events.c.seq))
+
+
+# one tailing thread per process, running only while someone is subscribed; subscribers get a queue each
+class ChangeBroker:
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._wake = threading.Event()
+        self._thread = None
+        self._last_seq = 0
+
+    def subscribe(self, engine, user_id):
+        events = queue.SimpleQueue()
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(events)
+            if self._thread is None:
+                with engine.connect() as connection:
+                    self._last_seq = connection.scalar(select(func.coalesce(func.max(_events.c.seq), 0)))
+                self._thread = threading.Thread(target=self._run, args=(engine,), daemon=True)
+                self._thread.start()
+        return events
+
+    def unsubscribe(self, user_id, events):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id, set())
+            subscribers.discard(events)
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self, engine):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                with engine.connect() as connection:
+                    rows = connection.execute(_select_events(self._last_seq).limit(BACKLOG_LIMIT)).all()
+            except Exception:
+                continue
+            with self._lock:
+                for row in rows:
+                    for events in self._subscribers.get(row.user_id, ()):
+                        events.put(_payload(row))
+            if rows:
+                self._last_seq = rows[-1].seq
+
+
+broker = ChangeBroker()
+
+
+def _format(payload):
+    return f"id: {payload['seq']}\nevent: change\ndata: {json.dumps(payload)}\n\n"
+
+
+# SSE frames for one user: missed events after last_seq first, then live ones, with keep-alive comments.
+# Only the broker thread touches the database while the stream waits.
+def stream_events(engine, user_id, last_seq=None):
+    events = broker.subscribe(engine, user_id)
+    try:
+        yield f'retry: {int(POLL_INTERVAL * 2000)}\n\n'
+        if last_seq is not None:
+            with engine.connect() as connection:
+                oldest = connection.scalar(select(func.min(_events.c.seq)))
+                backlog = connection.execute(_select_events(last_seq).where(_events.c.user_id == user_id)
+                                             .limit(BACKLOG_LIMIT)).all()
+            # events were pruned (or too many missed): the client has to reload everything
+            if (oldest is not None and oldest > last_seq + 1) or len(backlog) == BACKLOG_LIMIT:
+                yield 'event: reset\ndata: {}\n\n'
+            else:
+                for row in backlog:
+                    yield _format(_payload(row))
+                    last_seq = row.seq
+        while True:
+            try:
+                payload = events.get(timeout=KEEPALIVE)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            if last_seq is not None and payload['seq'] <= last_seq:
+                continue
+            yield _format(payload)
+    finally:
+        broker.unsubscribe(user_id, events)
+
+
+def prune_events(session, keep_hours):
+    cutoff = utcnow() - timedelta(hours=keep_hours)
+    deleted = session.execute(delete(ChangeEvent).where(ChangeEvent.created_at < cutoff)).rowcount
+    session.commit()
+    return deleted
@@ -0,0 +1,98 @@
+import numpy as np
+from grid import INSTRUMENTS, BEATS_PER_BAR
+from features import compute_features_batch
+
+# Practice exercises are drawn in batches: a few hundred candidate grids are generated at once under
+# constraints that keep them playable (a hat pulse, kick on every downbeat, snare on the backbeats, toms
+# only in the fill at the end of the phrase, at most two hands per step), scored for difficulty, and
+# the ones inside the level's difficulty band are kept.
+KICK, SNARE, HIGH_HAT, TOM1, TOM2 = (INSTRUMENTS.index(name) for name in ('kick', 'snare', 'high-hat', 'tom1', 'tom2'))
+HANDS = [SNARE, HIGH_HAT, TOM1, TOM2]
+BARS = 4
+MAX_EXERCISES = 100
+MIN_CANDIDATES = 256
+GHOST_VELOCITY = 40
+ACCENT_VELOCITY, WEAK_VELOCITY = 112, 76
+
+# hat_every: hat pulse in steps; hat_drop: chance to leave a weak hat out; kick: chance of an extra kick on
+# the strongest steps; offbeat: how much of that chance weak steps get; ghost: chance of a ghost snare;
+# fill: how much of the last bar the fill takes; fill_hits: chance of a hit on each fill step
+LEVELS = {
+    'beginner': dict(steps=8, bpm=(70, 95), hat_every=2, hat_drop=0.0, kick=0.35, offbeat=0.0, ghost=0.0,
+                     fill=0.25, fill_hits=0.6, accents=False, difficulty=(0.0, 0.3)),
+    'intermediate': dict(steps=16, bpm=(85, 115), hat_every=2, hat_drop=0.0, kick=0.45, offbeat=0.3, ghost=0.06,
+                         fill=0.5, fill_hits=0.6, accents=True, difficulty=(0.3, 0.5)),
+    'advanced': dict(steps=16, bpm=(100, 140), hat_every=1, hat_drop=0.2, kick=0.55, offbeat=0.7, ghost=0.15,
+                     fill=0.5, fill_hits=0.85, accents=True, difficulty=(0.5, 1.0)),
+}
+
+
+# 1 on the downbeat, falling to 0 on the weakest subdivision of the bar
+def _strength(steps):
+    return np.log2(np.gcd(np.arange(steps), steps)) / np.log2(steps)
+
+
+# n candidate grids (n, instruments, BARS, steps) for a level, all constraints applied
+def generate_candidates(level, n, rng):
+    params = LEVELS[level]
+    steps = params['steps']
+    strength = _strength(steps)
+    grids = np.zeros((n, len(INSTRUMENTS), BARS, steps), dtype=np.int16)
+    draw = rng.random((4, n, BARS, steps))
+
+    pulse = np.arange(steps) % params['hat_every'] == 0
+    hats = pulse & ((strength >= 0.5) | (draw[0] >= params['hat_drop']))
+    grids[:, HIGH_HAT] = np.where(hats, np.where(strength >= 0.5, ACCENT_VELOCITY, WEAK_VELOCITY) if params['accents']
+                                  else 1, 0)
+    kick_chance = params['kick'] * (strength + params['offbeat'] * (1 - strength))
+    grids[:, KICK] = draw[1] < kick_chance
+    grids[:, KICK, :, 0] = 1
+    backbeats = np.zeros(steps, dtype=bool)
+    backbeats[[steps // 4, 3 * steps // 4]] = True
+    grids[:, SNARE] = np.where(backbeats, 1, np.where((draw[2] < params['ghost']) & ~pulse, GHOST_VELOCITY, 0))
+
+    # the fill: the end of the last bar, hands moving between snare and toms
+    fill_steps = np.arange(steps) >= steps - int(steps * params['fill'])
+    fill = (draw[3, :, -1] < params['fill_hits']) & fill_steps
+    drum = np.array([SNARE, TOM1, TOM2])[rng.integers(0, 3, (n, steps))]
+    candidates, step = np.nonzero(fill)
+    grids[:, HIGH_HAT, -1, fill_steps] = 0
+    grids[:, SNARE, -1, fill_steps] = 0
+    grids[candidates, drum[candidates, step], -1, step] = 1
+
+    # two hands: drop the hat, then the lower tom, where more than two hand drums would sound together
+    for dropped in (HIGH_HAT, TOM2):
+        crowded = (grids[:, HANDS] > 0).sum(axis=1) > 2
+        grids[:, dropped][crowded] = 0
+    return grids
+
+
+# 0..1 from the onsets per second, syncopation, the fill and how often the kick plays without the hat
+def difficulty_scores(grids, bpm):
+    features = compute_features_batch(grids)
+    onsets = (grids > 0).any(axis=1).sum(axis=(1, 2))
+    seconds = BARS * BEATS_PER_BAR * 60 / bpm
+    kicks = grids[:, KICK] > 0
+    independence = (kicks & (grids[:, HIGH_HAT] == 0)).sum(axis=(1, 2)) / np.maximum(kicks.sum(axis=(1, 2)), 1)
+    return (0.4 * np.minimum(onsets / seconds / 8, 1)
+            + 0.3 * np.minimum(features['syncopation'], 1)
+            + 0.15 * np.minimum(features['fill_density'] * 4, 1)
+            + 0.15 * independence)
+
+
+# `count` distinct exercises for a level: returns (grids, bpms, difficulties), sorted by difficulty. Candidates
+# inside the level's band come first; if too few land there, the closest ones outside make up the rest.
+def generate_exercises(level, count, rng=None):
+    rng = rng or np.random.default_rng()
+    params = LEVELS[level]
+    n = max(count * 16, MIN_CANDIDATES)
+    grids = generate_candidates(level, n, rng)
+    bpm = rng.integers(params['bpm'][0], params['bpm'][1] + 1, n)
+    difficulty = difficulty_scores(grids, bpm)
+
+    _, distinct = np.unique(grids.reshape(n, -1), axis=0, return_index=True)
+    low, high = params['difficulty']
+    distance = np.maximum(low - difficulty[distinct], 0) + np.maximum(difficulty[distinct] - high, 0)
+    chosen = distinct[np.lexsort((rng.random(len(distinct)), distance))[:count]]
+    chosen = chosen[np.argsort(difficulty[chosen], kind='stable')]
+    return grids[chosen], bpm[chosen], difficulty[chosen]
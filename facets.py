@@ -0,0 +1,83 @@
+from sqlalchemy import text
+
+# beat_facet holds beat counts per (user, facet, value); user_id 0 is the count over all users.
+# Triggers on beat keep it current inside the same transaction as the write, whichever path made it.
+GLOBAL_SCOPE = 0
+BPM_BUCKET = 10
+
+
+def _facet_values(row):
+    return [('genre', f'lower(trim({row}.genre))'),
+            ('bpm', f'CAST(({row}.bpm / {BPM_BUCKET}) * {BPM_BUCKET} AS TEXT)')]
+
+
+def _scopes(row):
+    return [f'{row}.user_id', str(GLOBAL_SCOPE)]
+
+
+def _increment(row):
+    return ''.join(
+        f'INSERT INTO beat_facet (user_id, facet, value, count) VALUES ({scope}, \'{facet}\', {value}, 1) '
+        f'ON CONFLICT (user_id, facet, value) DO UPDATE SET count = count + 1; '
+        for scope in _scopes(row) for facet, value in _facet_values(row))
+
+
+def _decrement(row):
+    return ''.join(
+        f'UPDATE beat_facet SET count = count - 1 WHERE user_id = {scope} AND facet = \'{facet}\' AND value = {value}; '
+        f'DELETE FROM beat_facet WHERE user_id = {scope} AND facet = \'{facet}\' AND value = {value} AND count <= 0; '
+        for scope in _scopes(row) for facet, value in _facet_values(row))
+
+
+FACET_TRIGGERS = [
+    f'CREATE TRIGGER IF NOT EXISTS beat_facet_ai AFTER INSERT ON beat BEGIN {_increment("new")}END',
+    f'CREATE TRIGGER IF NOT EXISTS beat_facet_ad AFTER DELETE ON beat BEGIN {_decrement("old")}END',
+    f'CREATE TRIGGER IF NOT EXISTS beat_facet_au AFTER UPDATE OF genre, bpm, user_id ON beat BEGIN '
+    f'{_decrement("old")}{_increment("new")}END',
+]
+
+# what the aggregate must equal, computed the slow way
+EXPECTED_SQL = ' UNION ALL '.join(
+    f'SELECT {scope} AS user_id, \'{facet}\' AS facet, {value} AS value, count(*) AS count FROM beat b '
+    f'GROUP BY 1, 2, 3'
+    for scope in ('b.user_id', str(GLOBAL_SCOPE)) for facet, value in _facet_values('b'))
+
+
+def create_facet_triggers(connection):
+    for statement in FACET_TRIGGERS:
+        connection.exec_driver_sql(statement)
+    if connection.exec_driver_sql('SELECT 1 FROM beat_facet LIMIT 1').first() is None:
+        rebuild_facets(connection)
+
+
+def rebuild_facets(connection):
+    connection.exec_driver_sql('DELETE FROM beat_facet')
+    connection.exec_driver_sql(f'INSERT INTO beat_facet (user_id, facet, value, count) {EXPECTED_SQL}')
+
+
+# rows where the maintained counts and a full GROUP BY disagree: (user_id, facet, value, stored, expected)
+def facet_drift(connection):
+    return connection.execute(text(f"""
+        WITH expected AS ({EXPECTED_SQL})
+        SELECT e.user_id, e.facet, e.value, f.count, e.count FROM expected e
+        LEFT JOIN beat_facet f ON f.user_id = e.user_id AND f.facet = e.facet AND f.value = e.value
+        WHERE f.count IS NOT e.count
+        UNION ALL
+        SELECT f.user_id, f.facet, f.value, f.count, NULL FROM beat_facet f
+        WHERE NOT EXISTS (SELECT 1 FROM expected e
+                          WHERE e.user_id = f.user_id AND e.facet = f.facet AND e.value = f.value)
+    """)).all()
+
+
+def facet_counts(connection, user_id):
+    rows = connection.execute(text(
+        'SELECT user_id, facet, value, count FROM beat_facet WHERE user_id IN (:user_id, :all) '
+        'ORDER BY count DESC, value'), {'user_id': user_id, 'all': GLOBAL_SCOPE})
+    result = {'user': {'genre': [], 'bpm': []}, 'global': {'genre': [], 'bpm': []}}
+    for scope, facet, value, count in rows:
+        if facet == 'bpm':
+            entry = {'bpm_min': int(value), 'bpm_max': int(value) + BPM_BUCKET - 1, 'count': count}
+        else:
+            entry = {'genre': value, 'count': count}
+        result['global' if scope == GLOBAL_SCOPE else 'user'][facet].append(entry)
+    return result
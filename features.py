@@ -0,0 +1,84 @@
+import json
+import numpy as np
+from grid import INSTRUMENTS, decode_grid
+
+# rhythmic features stored on each BeatPattern; GET /beats filters on them with ?min_<name>=&max_<name>=
+DENSITY_COLUMNS = ['density_' + instrument.replace('-', '_') for instrument in INSTRUMENTS]
+FEATURE_COLUMNS = ['density'] + DENSITY_COLUMNS + ['syncopation', 'backbeat', 'fill_density', 'total_bars']
+
+KICK, SNARE, TOM1, TOM2 = (INSTRUMENTS.index(name) for name in ('kick', 'snare', 'tom1', 'tom2'))
+
+
+def _metric_strength(steps):
+    # how strong each step of a bar is: the downbeat strongest, then half bar, quarters, ...
+    return np.log2(np.gcd(np.arange(steps), steps) if steps else np.ones(0)).astype(np.float32)
+
+
+def _backbeat_mask(steps):
+    mask = np.zeros(steps, dtype=bool)
+    if steps and steps % 4 == 0:
+        mask[[steps // 4, 3 * steps // 4]] = True
+    return mask
+
+
+# features for a batch of same-shaped grids, shape (n, instruments, bars, steps); returns {column: array of n}
+def compute_features_batch(grids):
+    n, _, bars, steps = grids.shape
+    hits = grids > 0
+    cells = max(bars * steps, 1)
+    features = {'total_bars': np.full(n, bars)}
+
+    per_instrument = hits.sum(axis=(2, 3)) / cells
+    for i, column in enumerate(DENSITY_COLUMNS):
+        features[column] = per_instrument[:, i]
+    features['density'] = per_instrument.mean(axis=1)
+
+    # onsets on a weak step followed by a rest on a stronger one, weighted by the strength gap
+    onsets = hits.any(axis=1).reshape(n, -1)
+    strength = np.tile(_metric_strength(steps), bars)
+    following = np.roll(onsets, -1, axis=1)
+    gap = np.roll(strength, -1) - strength
+    syncopated = onsets & ~following & (gap > 0)
+    features['syncopation'] = (syncopated * gap).sum(axis=1) / np.maximum(onsets.sum(axis=1), 1)
+
+    backbeats = _backbeat_mask(steps)
+    slots = max(int(backbeats.sum()) * bars, 1)
+    features['backbeat'] = hits[:, SNARE][:, :, backbeats].sum(axis=(1, 2)) / slots
+
+    # fills: toms or off-backbeat snares in the last bar of every 4-bar phrase and in the final bar
+    fill_bars = (np.arange(bars) % 4 == 3) | (np.arange(bars) == bars - 1)
+    fills = hits[:, TOM1] | hits[:, TOM2] | (hits[:, SNARE] & ~backbeats)
+    features['fill_density'] = fills[:, fill_bars].sum(axis=(1, 2)) / max(int(fill_bars.sum()) * steps, 1)
+    return features
+
+
+# feature values of a grid that can't be decoded
+UNDECODABLE = {**dict.fromkeys(FEATURE_COLUMNS), 'undecodable': True}
+
+
+def compute_features(beat_schema):
+    try:
+        grid = decode_grid(beat_schema)
+    except (KeyError, ValueError):
+        return dict(UNDECODABLE)
+    batch = compute_features_batch(grid[None])
+    return {**{column: values[0].item() for column, values in batch.items()}, 'undecodable': False}
+
+
+# worker entry point for the parallel backfill: [(id, json)] -> [(id, features)], grouping same shapes
+def features_for_rows(rows):
+    grids, results = {}, []
+    for pattern_id, beat_schema in rows:
+        try:
+            grid = decode_grid(json.loads(beat_schema))
+        except (KeyError, ValueError):
+            results.append((pattern_id, dict(UNDECODABLE)))
+            continue
+        grids.setdefault(grid.shape, []).append((pattern_id, grid))
+
+    for group in grids.values():
+        batch = compute_features_batch(np.stack([grid for _, grid in group]))
+        for i, (pattern_id, _) in enumerate(group):
+            results.append((pattern_id, {**{column: values[i].item() for column, values in batch.items()},
+                                         'undecodable': False}))
+    return results
@@ -0,0 +1,50 @@
+import hashlib
+import json
+import numpy as np
+
+# beat_schema is {instrument: [bar, ...]} where each bar is a list of steps. A step value of 0 is a rest,
+# 1 a normal hit and 2..127 a hit with that MIDI velocity. Every bar is one 4/4 measure.
+INSTRUMENTS = ['kick', 'snare', 'high-hat', 'tom1', 'tom2']
+BEATS_PER_BAR = 4
+DEFAULT_VELOCITY = 100
+
+
+# (instrument, bar, step) int16 array in INSTRUMENTS order
+def decode_grid(beat_schema):
+    try:
+        grid = np.array([beat_schema[instrument] for instrument in INSTRUMENTS], dtype=np.int16)
+    except ValueError:
+        raise ValueError('every instrument needs the same number of bars and every bar the same number of steps') from None
+    except (OverflowError, TypeError):
+        raise ValueError('every step must be an integer from 0 to 127') from None
+    except KeyError:
+        raise ValueError(f'beat schema must contain every instrument: {INSTRUMENTS}') from None
+    if grid.ndim == 2:
+        # no bars at all
+        grid = grid.reshape(len(INSTRUMENTS), 0, 0)
+    return grid
+
+
+def encode_grid(grid):
+    return {instrument: grid[i].tolist() for i, instrument in enumerate(INSTRUMENTS)}
+
+
+# per-hit velocities over a grid, 0 where there is no hit
+def velocities(grid):
+    return np.where(grid == 1, DEFAULT_VELOCITY, np.clip(grid, 0, 127)).astype(np.uint8)
+
+
+def step_seconds(bpm, steps_per_bar):
+    return 60.0 / bpm * BEATS_PER_BAR / steps_per_bar
+
+
+def canonical_json(beat_schema):
+    return json.dumps(beat_schema, sort_keys=True, separators=(',', ':'))
+
+
+# stable hash of a grid plus anything else its derived artifact depends on (bpm, options, ...)
+def content_hash(beat_schema, *extra):
+    digest = hashlib.sha256(canonical_json(beat_schema).encode())
+    for part in extra:
+        digest.update(b'\0' + json.dumps(part, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
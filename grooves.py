@@ -0,0 +1,36 @@
+import numpy as np
+
+# A groove is {'swing': 50..75, 'micro_timing': [...], 'velocity_offsets': [...], 'id', 'version'}, as
+# GrooveTemplate.to_dict() gives it. Swing is the MPC-style percentage: 50 is straight, 66 a triplet feel,
+# and it delays the second step of every pair. micro_timing (in steps) and velocity_offsets repeat across
+# each bar. Timelines, MIDI and audio all apply it through groove_steps(); since the dict carries the
+# template's id and version, hashing it into a cache key keys the result on the template version.
+
+
+# (timing offset in steps, velocity offset) for each of `steps` grid steps; zeros without a groove
+def groove_offsets(groove, steps, steps_per_bar):
+    timing = np.zeros(steps)
+    velocity = np.zeros(steps, dtype=np.int16)
+    if not groove or not steps:
+        return timing, velocity
+    index = np.arange(steps)
+    timing[index % 2 == 1] += (groove['swing'] - 50) / 50
+    in_bar = index % steps_per_bar
+    if groove['micro_timing']:
+        micro = np.asarray(groove['micro_timing'], dtype=np.float64)
+        timing += micro[in_bar % len(micro)]
+    if groove['velocity_offsets']:
+        offsets = np.asarray(groove['velocity_offsets'], dtype=np.int16)
+        velocity += offsets[in_bar % len(offsets)]
+    return timing, velocity
+
+
+# applies a groove to per-step hit velocities (instruments, steps): returns the step positions, now
+# fractional and never before the start, and the shifted velocities, kept within 1..127 where there is a hit
+def groove_steps(hits, groove, steps_per_bar):
+    timing, velocity = groove_offsets(groove, hits.shape[-1], steps_per_bar)
+    positions = np.maximum(np.arange(hits.shape[-1]) + timing, 0)
+    if not velocity.any():
+        return positions, hits
+    shifted = np.clip(hits.astype(np.int16) + velocity, 1, 127).astype(hits.dtype)
+    return positions, np.where(hits > 0, shifted, 0).astype(hits.dtype)
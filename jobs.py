@@ -0,0 +1,154 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from sqlalchemy import create_engine, select, update, func, exists
+from sqlalchemy.orm import aliased
+from models import db, RenderJob, utcnow
+from grid import content_hash
+from render import render_chunks, write_wav
+from samplebank import DEFAULT_KIT, load_kit
+
+SHARED_STATUSES = ('queued', 'running', 'done')
+# seconds without a heartbeat after which a running job's worker is taken to be dead
+STALE_AFTER = 300
+
+
+def render_path(render_dir, digest):
+    return os.path.join(render_dir, f'{digest}.wav')
+
+
+# returns (job, created); the user's queued, running or finished job for the same content is reused.
+# A file already rendered for someone else is shared through a new job that starts out done.
+# `kit` is the sample-bank kit to render with.
+def enqueue_render(beat, user_id, options, render_dir, kit=DEFAULT_KIT):
+    digest = content_hash(beat.beat_schema, beat.bpm, options, kit)
+    rendered = os.path.exists(render_path(render_dir, digest))
+    job = (RenderJob.query.filter(RenderJob.content_hash == digest, RenderJob.user_id == user_id,
+                                  RenderJob.status.in_(SHARED_STATUSES))
+           .order_by(RenderJob.id.desc()).first())
+    if job is not None and (job.status != 'done' or rendered):
+        return job, False
+
+    job = RenderJob(content_hash=digest, beat_id=beat.id, user_id=user_id,
+                    params={'beat_schema': beat.beat_schema, 'bpm': beat.bpm, 'options': options, 'kit': kit})
+    if rendered:
+        job.status, job.progress, job.finished_at = 'done', 1.0, utcnow()
+    db.session.add(job)
+    db.session.commit()
+    return job, True
+
+
+def cancel_render(job):
+    cancelled = db.session.execute(
+        update(RenderJob).where(RenderJob.id == job.id, RenderJob.status.in_(('queued', 'running')))
+        .values(status='cancelled', finished_at=utcnow()).execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return bool(cancelled)
+
+
+# the oldest queued job whose content isn't being rendered already; jobs of other users for the same
+# content wait and are finished together with the one that renders it
+def claim_next():
+    running = aliased(RenderJob)
+    in_flight = exists().where(running.content_hash == RenderJob.content_hash, running.status == 'running')
+    oldest = (select(RenderJob.id).where(RenderJob.status == 'queued', ~in_flight)
+              .order_by(RenderJob.id).limit(1))
+    row = db.session.execute(
+        update(RenderJob).where(RenderJob.id == oldest.scalar_subquery(), RenderJob.status == 'queued')
+        .values(status='running', started_at=utcnow(), heartbeat_at=utcnow())
+        .returning(RenderJob.id, RenderJob.content_hash, RenderJob.params)
+        .execution_options(synchronize_session=False)
+    ).first()
+    db.session.commit()
+    return row
+
+
+# jobs left running by a worker that stopped sending heartbeats are queued again; returns how many
+def requeue_stale(stale_after=STALE_AFTER):
+    cutoff = utcnow() - timedelta(seconds=stale_after)
+    requeued = db.session.execute(
+        update(RenderJob).where(RenderJob.status == 'running',
+                                func.coalesce(RenderJob.heartbeat_at, RenderJob.started_at) < cutoff)
+        .values(status='queued').execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return requeued
+
+
+# runs in a worker process: renders to a temporary file, reporting progress and stopping when cancelled.
+# Queued jobs for the same content follow the render's progress and are done when it is.
+def run_render_job(db_url, job_id, content_hash, params, out_path, bank_dir):
+    engine = create_engine(db_url)
+    jobs = RenderJob.__table__
+    waiting = (jobs.c.content_hash == content_hash) & (jobs.c.status == 'queued')
+
+    def set_status(status, error=None):
+        values = {'status': status, 'error': error, 'finished_at': utcnow()}
+        if status == 'done':
+            values['progress'] = 1.0
+        with engine.begin() as connection:
+            connection.execute(update(jobs).where(jobs.c.id == job_id, jobs.c.status == 'running').values(**values))
+            if status == 'done':
+                connection.execute(update(jobs).where(waiting).values(**values))
+
+    if os.path.exists(out_path):
+        set_status('done')
+        return
+
+    options = params['options']
+    chunks = options.get('loops', 1) + 1
+
+    def on_chunk(i):
+        with engine.begin() as connection:
+            connection.execute(update(jobs).where(jobs.c.id == job_id)
+                               .values(progress=(i + 1) / chunks, heartbeat_at=utcnow()))
+            connection.execute(update(jobs).where(waiting).values(progress=(i + 1) / chunks))
+            return connection.scalar(select(jobs.c.status).where(jobs.c.id == job_id)) == 'running'
+
+    partial = f'{out_path}.{job_id}.part'
+    try:
+        voices = load_kit(bank_dir, params.get('kit', DEFAULT_KIT))
+        finished = write_wav(partial, render_chunks(params['beat_schema'], params['bpm'], voices=voices, **options),
+                             on_chunk)
+        if finished:
+            os.replace(partial, out_path)
+            set_status('done')
+    except Exception as err:
+        set_status('failed', error=str(err))
+        raise
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+        engine.dispose()
+
+
+# the worker loop: at most `concurrency` renders run at once in a process pool; call inside an app context.
+# Pool processes live across jobs, so each maps the sample bank once. Whenever the queue is empty, jobs
+# of workers that died are picked up again; other live workers keep theirs.
+def run_worker(render_dir, bank_dir, concurrency, poll_interval=1.0, once=False, log=print, stale_after=STALE_AFTER):
+    os.makedirs(render_dir, exist_ok=True)
+    db_url = db.engine.url.render_as_string(hide_password=False)
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            for future in [future for future in running if future.done()]:
+                job_id = running.pop(future)
+                error = future.exception()
+                log(f'render job {job_id} ' + (f'failed: {error}' if error else 'finished'))
+
+            while len(running) < concurrency:
+                job = claim_next()
+                if job is None and requeue_stale(stale_after):
+                    job = claim_next()
+                if job is None:
+                    break
+                log(f'render job {job.id} started')
+                running[pool.submit(run_render_job, db_url, job.id, job.content_hash, job.params,
+                                    render_path(render_dir, job.content_hash), bank_dir)] = job.id
+
+            if once and not running:
+                return
+            time.sleep(poll_interval)
@@ -0,0 +1,97 @@
+import hashlib
+import wave
+import numpy as np
+from grid import INSTRUMENTS
+from models import db, Kit
+from render import SAMPLE_RATE
+from samplebank import resample, write_kit
+
+# kit samples are cut to this length while they are decoded, so a long file is never held whole
+MAX_SECONDS = 4.0
+MAX_KIT_UPLOAD = 64 * 1024 * 1024
+CHUNK_FRAMES = 16384
+# trimming drops what is quieter than this (relative to full scale) before the first and after the last sound
+SILENCE_THRESHOLD = 10 ** (-50 / 20)
+NORMALIZE_PEAK = 0.9
+FADE_SECONDS = 0.005
+
+
+def _pcm_to_float(frames, sample_width, channels):
+    if sample_width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(frames, dtype='<i2').astype(np.float32) / 32768
+    elif sample_width == 3:
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((raw[:, 0] | raw[:, 1] << 8 | raw[:, 2] << 16) << 8 >> 8).astype(np.float32) / 8388608
+    else:
+        samples = np.frombuffer(frames, dtype='<i4').astype(np.float32) / 2147483648
+    return samples.reshape(-1, channels).mean(axis=1)
+
+
+# yields (sample_rate, mono float32 chunk) from a PCM WAV stream, CHUNK_FRAMES at a time and at most
+# max_seconds of it
+def iter_wav(stream, max_seconds=MAX_SECONDS):
+    try:
+        with wave.open(stream, 'rb') as source:
+            rate, width, channels = source.getframerate(), source.getsampwidth(), source.getnchannels()
+            if width not in (1, 2, 3, 4):
+                raise ValueError(f'unsupported sample width of {width} bytes')
+            remaining = min(source.getnframes(), int(max_seconds * rate))
+            while remaining > 0:
+                frames = source.readframes(min(CHUNK_FRAMES, remaining))
+                if not frames:
+                    break
+                chunk = _pcm_to_float(frames, width, channels)
+                remaining -= len(chunk)
+                yield rate, chunk
+    except (wave.Error, EOFError) as err:
+        raise ValueError(f'not a PCM WAV file: {err}') from None
+
+
+# the first MAX_SECONDS of a PCM WAV stream as mono float32; returns (samples, sample_rate)
+def read_wav(stream):
+    rate, chunks = None, []
+    for rate, chunk in iter_wav(stream):
+        chunks.append(chunk)
+    return (np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)), rate
+
+
+# resampled, trimmed of leading and trailing silence, peak-normalized and faded out at the cut
+def preprocess(samples, rate):
+    samples = resample(samples, rate)
+    loud = np.flatnonzero(np.abs(samples) > SILENCE_THRESHOLD)
+    if not len(loud):
+        raise ValueError('the sample is silent')
+    samples = samples[loud[0]:loud[-1] + 1] / np.abs(samples).max() * NORMALIZE_PEAK
+    fade = min(int(FADE_SECONDS * SAMPLE_RATE), len(samples))
+    samples[len(samples) - fade:] *= np.linspace(1, 0, fade, dtype=np.float32)
+    return samples.astype(np.float32)
+
+
+def kit_hash(voices):
+    digest = hashlib.sha256()
+    for instrument in INSTRUMENTS:
+        digest.update(instrument.encode() + b'\0' + voices[instrument].tobytes())
+    return digest.hexdigest()
+
+
+# preprocesses {instrument: (samples, rate)} into the sample bank; returns (kit, created).
+# Identical processed sounds share one copy in the bank, and a user uploading them again gets the same kit.
+def create_kit(user_id, name, sources, bank_dir):
+    voices = {}
+    for instrument in INSTRUMENTS:
+        try:
+            voices[instrument] = preprocess(*sources[instrument])
+        except ValueError as err:
+            raise ValueError(f'{instrument}: {err}') from None
+    digest = kit_hash(voices)
+
+    kit = Kit.query.filter_by(user_id=user_id, content_hash=digest).first()
+    if kit is not None:
+        return kit, False
+    write_kit(bank_dir, Kit.bank_name(digest), {instrument: (voice, SAMPLE_RATE) for instrument, voice in voices.items()})
+    kit = Kit(name=name, user_id=user_id, content_hash=digest)
+    db.session.add(kit)
+    db.session.commit()
+    return kit, True
@@ -0,0 +1,111 @@
+from sqlalchemy import text
+from practice import ALL_BEATS
+
+# A leaderboard ranks players by their best practice score: per beat, and over all beats as beat_id 0,
+# straight from the practice_progress rows. Players are ordered by best_score, then by who got there
+# first (best_at), then user_id, which ix_practice_progress_rank serves in order for the top N.
+# For a player's rank, leaderboard_bucket counts players per whole point (scale 1) and per hundredth
+# (scale 100, i.e. per distinct score), kept by triggers on practice_progress. The players above someone
+# are then at most 100 point counts, at most 99 hundredth counts inside their point and an index range
+# over the players tied on their exact score, however many players rank higher.
+# Deleting a user deletes their progress rows (practice_progress_user_ad), which keeps the buckets exact;
+# rows of users deleted before that trigger existed are skipped here and removed by gc-orphans.
+MAX_LIMIT = 100
+
+
+def _hundredths(row):
+    return f'CAST(round({row}.best_score * 100) AS INTEGER)'
+
+
+def _buckets(row):
+    return [(1, f'{_hundredths(row)} / 100'), (100, _hundredths(row))]
+
+
+def _increment(row):
+    return ''.join(
+        f'INSERT INTO leaderboard_bucket (beat_id, scale, bucket, count) VALUES ({row}.beat_id, {scale}, {bucket}, 1) '
+        'ON CONFLICT (beat_id, scale, bucket) DO UPDATE SET count = count + 1; '
+        for scale, bucket in _buckets(row))
+
+
+def _decrement(row):
+    return ''.join(
+        f'UPDATE leaderboard_bucket SET count = count - 1 '
+        f'WHERE beat_id = {row}.beat_id AND scale = {scale} AND bucket = {bucket}; '
+        f'DELETE FROM leaderboard_bucket '
+        f'WHERE beat_id = {row}.beat_id AND scale = {scale} AND bucket = {bucket} AND count <= 0; '
+        for scale, bucket in _buckets(row))
+
+
+LEADERBOARD_TRIGGERS = [
+    f'CREATE TRIGGER IF NOT EXISTS leaderboard_bucket_ai AFTER INSERT ON practice_progress BEGIN {_increment("new")}END',
+    f'CREATE TRIGGER IF NOT EXISTS leaderboard_bucket_ad AFTER DELETE ON practice_progress BEGIN {_decrement("old")}END',
+    'CREATE TRIGGER IF NOT EXISTS leaderboard_bucket_au AFTER UPDATE OF best_score ON practice_progress '
+    f'WHEN {_hundredths("old")} IS NOT {_hundredths("new")} BEGIN {_decrement("old")}{_increment("new")}END',
+]
+
+
+def create_leaderboard_triggers(connection):
+    for statement in LEADERBOARD_TRIGGERS:
+        connection.exec_driver_sql(statement)
+    if connection.exec_driver_sql('SELECT 1 FROM leaderboard_bucket LIMIT 1').first() is None:
+        rebuild_buckets(connection)
+
+
+def rebuild_buckets(connection):
+    connection.exec_driver_sql('DELETE FROM leaderboard_bucket')
+    for scale, bucket in _buckets('p'):
+        connection.exec_driver_sql(
+            f'INSERT INTO leaderboard_bucket (beat_id, scale, bucket, count) '
+            f'SELECT beat_id, {scale}, {bucket}, count(*) FROM practice_progress p GROUP BY 1, 3')
+
+
+def top_entries(connection, beat_id, limit):
+    rows = connection.execute(text(
+        'SELECT p.user_id, u.username, p.best_score, p.attempts FROM practice_progress p '
+        'JOIN user u ON u.id = p.user_id WHERE p.beat_id = :beat_id '
+        'ORDER BY p.best_score DESC, p.best_at, p.user_id LIMIT :limit'), {'beat_id': beat_id, 'limit': limit})
+    return [{'rank': rank, 'user_id': user_id, 'username': username, 'best_score': best_score, 'attempts': attempts}
+            for rank, (user_id, username, best_score, attempts) in enumerate(rows, start=1)]
+
+
+def player_count(connection, beat_id):
+    return connection.execute(text(
+        'SELECT coalesce(sum(count), 0) FROM leaderboard_bucket WHERE beat_id = :beat_id AND scale = 1'),
+        {'beat_id': beat_id}).scalar()
+
+
+# {'rank', 'best_score'} of a player, None if they have no attempt on the leaderboard yet
+def player_rank(connection, beat_id, user_id):
+    row = connection.execute(text(f"""
+        WITH me AS (
+            SELECT best_score, best_at, {_hundredths('p')} AS hundredths FROM practice_progress p
+            WHERE beat_id = :beat_id AND user_id = :user_id AND EXISTS (SELECT 1 FROM user u WHERE u.id = p.user_id)
+        )
+        SELECT me.best_score,
+               (SELECT coalesce(sum(b.count), 0) FROM leaderboard_bucket b
+                WHERE b.beat_id = :beat_id AND b.scale = 1 AND b.bucket > me.hundredths / 100)
+             + (SELECT coalesce(sum(b.count), 0) FROM leaderboard_bucket b
+                WHERE b.beat_id = :beat_id AND b.scale = 100 AND b.bucket > me.hundredths
+                  AND b.bucket < (me.hundredths / 100 + 1) * 100)
+             + (SELECT count(*) FROM practice_progress p
+                WHERE p.beat_id = :beat_id AND p.best_score BETWEEN me.best_score - 0.01 AND me.best_score + 0.01
+                  AND {_hundredths('p')} = me.hundredths
+                  AND EXISTS (SELECT 1 FROM user u WHERE u.id = p.user_id)
+                  AND (p.best_score > me.best_score OR (p.best_score = me.best_score AND (p.best_at < me.best_at
+                       OR (p.best_at = me.best_at AND p.user_id < :user_id)))))
+             + 1
+        FROM me
+    """), {'beat_id': beat_id, 'user_id': user_id}).first()
+    if row is None:
+        return None
+    return {'rank': row[1], 'best_score': row[0]}
+
+
+def leaderboard(connection, beat_id, user_id, limit):
+    return {
+        'beat_id': beat_id if beat_id != ALL_BEATS else None,
+        'players': player_count(connection, beat_id),
+        'top': top_entries(connection, beat_id, limit),
+        'me': player_rank(connection, beat_id, user_id),
+    }
@@ -0,0 +1,98 @@
+import io
+import struct
+import zipfile
+import numpy as np
+from grid import INSTRUMENTS, BEATS_PER_BAR, decode_grid, velocities, content_hash
+from cache import LRUCache
+from grooves import groove_steps
+
+TICKS_PER_BEAT = 480
+# General MIDI percussion lives on channel 10 (index 9)
+DRUM_CHANNEL = 9
+GM_DRUM_NOTES = {'kick': 36, 'snare': 38, 'high-hat': 42, 'tom1': 48, 'tom2': 45}
+NOTE_TICKS = 60
+
+_midi_cache = LRUCache(maxsize=512)
+
+
+# MIDI variable-length quantities for an array of ints below 2**28: (n, 4) bytes and which of them are used
+def _vlq(values):
+    values = values.astype(np.uint32)
+    groups = np.stack([(values >> shift) & 0x7f for shift in (21, 14, 7, 0)], axis=1).astype(np.uint8)
+    groups[:, :3] |= 0x80
+    lengths = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    return groups, np.arange(4) >= 4 - lengths[:, None]
+
+
+def _note_events(grid, ticks_per_step, groove):
+    notes = np.array([GM_DRUM_NOTES[instrument] for instrument in INSTRUMENTS], dtype=np.uint8)
+    positions, hits = groove_steps(velocities(grid.reshape(len(INSTRUMENTS), -1)), groove, grid.shape[2])
+    instrument, step = np.nonzero(hits)
+    on = np.rint(positions[step] * ticks_per_step).astype(np.int64)
+    off = on + int(min(NOTE_TICKS, ticks_per_step))
+
+    ticks = np.concatenate([on, off])
+    # note-offs sort before note-ons on the same tick
+    kind = np.concatenate([np.ones_like(on), np.zeros_like(off)])
+    status = np.where(kind == 1, 0x90 | DRUM_CHANNEL, 0x80 | DRUM_CHANNEL).astype(np.uint8)
+    data = np.stack([np.tile(notes[instrument], 2),
+                     np.concatenate([hits[instrument, step], np.zeros_like(off, dtype=np.uint8)])], axis=1)
+    order = np.lexsort((kind, ticks))
+    return ticks[order], status[order], data[order]
+
+
+def _track(grid, bpm, groove):
+    bars, steps_per_bar = grid.shape[1], grid.shape[2]
+    ticks_per_step = TICKS_PER_BEAT * BEATS_PER_BAR / steps_per_bar if steps_per_bar else 0
+    ticks, status, data = _note_events(grid, ticks_per_step, groove)
+
+    groups, mask = _vlq(np.diff(ticks, prepend=0))
+    rows = np.concatenate([groups, status[:, None], data], axis=1)
+    mask = np.concatenate([mask, np.ones((len(rows), 3), dtype=bool)], axis=1)
+
+    tempo = round(60_000_000 / bpm)
+    end = max(bars * BEATS_PER_BAR * TICKS_PER_BEAT - (int(ticks[-1]) if len(ticks) else 0), 0)
+    end_groups, end_mask = _vlq(np.array([end]))
+    return (b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big') + rows[mask].tobytes()
+            + end_groups[end_mask].tobytes() + b'\xff\x2f\x00')
+
+
+# Standard MIDI File (format 0) of a beat, cached by content hash; returns (hash, bytes)
+def beat_to_midi(beat_schema, bpm, groove=None):
+    if bpm <= 0:
+        raise ValueError('bpm must be positive')
+    key = content_hash(beat_schema, bpm, *([groove] if groove else []))
+
+    def build():
+        track = _track(decode_grid(beat_schema), bpm, groove)
+        return (b'MThd' + struct.pack('>IHHH', 6, 0, 1, TICKS_PER_BEAT)
+                + b'MTrk' + struct.pack('>I', len(track)) + track)
+
+    return key, _midi_cache.get_or_create(key, build)
+
+
+class _ZipSink(io.RawIOBase):
+    # write-only, unseekable: zipfile then writes data descriptors and we can hand out bytes as they come
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+# yields a zip archive piece by piece from an iterable of (filename, bytes)
+def stream_zip(files):
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+            yield sink.drain()
+    yield sink.drain()
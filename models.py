@@ -1,4 +1,10 @@
+from datetime import datetime, timezone
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from compression import CompressedText
+from grid import content_hash
+from features import compute_features
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
@@ -34,7 +40,7 @@ class User(db.Model):
 # new table at db -> Text
 class Text(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    content = db.Column(db.String, nullable=False)
+    content = db.Column(CompressedText, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     def to_dict(self):
@@ -56,12 +62,16 @@ class PageBlock(db.Model):
     page_id = db.Column(db.Integer, db.ForeignKey('page.id'), nullable=False)
     page = db.relationship('Page', back_populates='blocks')
 
+    # positions are sparse ranks, ordered reads on a page walk this index
+    __table_args__ = (db.Index('ix_page_block_page_position', 'page_id', 'position'),)
+
 
 # new table -> Pages
 class Page(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
-    blocks = db.relationship('PageBlock', back_populates='page', cascade='all, delete-orphan')
+    blocks = db.relationship('PageBlock', back_populates='page', cascade='all, delete-orphan',
+                             order_by='PageBlock.position')
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     def to_dict(self):
@@ -72,14 +82,109 @@ class Page(db.Model):
         }
 
 
+# grid_hash prefix of a pattern edited in place by a cell PATCH (see cells.py) and not rehashed yet by
+# compact_patterns. Hex digests sort before it, so pending patterns are one range of the grid_hash index.
+PENDING_HASH = 'pending:'
+PENDING_RANGE = "grid_hash >= 'pending:' AND grid_hash < 'pending;'"
+
+
+# one row per distinct grid, shared by every Beat with that grid; ref_count is kept by triggers on beat
+class BeatPattern(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    grid_hash = db.Column(db.String(64), unique=True, nullable=False)
+    beat_schema = db.Column(db.JSON, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    # rhythmic features of the grid, computed once when the pattern is created (see features.py)
+    density = db.Column(db.Float, index=True)
+    density_kick = db.Column(db.Float, index=True)
+    density_snare = db.Column(db.Float, index=True)
+    density_high_hat = db.Column(db.Float, index=True)
+    density_tom1 = db.Column(db.Float, index=True)
+    density_tom2 = db.Column(db.Float, index=True)
+    syncopation = db.Column(db.Float, index=True)
+    backbeat = db.Column(db.Float, index=True)
+    fill_density = db.Column(db.Float, index=True)
+    total_bars = db.Column(db.Integer, index=True)
+    # the grid could not be decoded, so its features stay NULL and backfill-features skips it
+    undecodable = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+
+    @classmethod
+    def for_schema(cls, beat_schema):
+        return cls.for_schemas([beat_schema])[0]
+
+    # one pattern per schema, looked up with a single query for bulk inserts. Missing grids are inserted
+    # with ON CONFLICT DO NOTHING, so one saved at the same time by another request is reused, not a 500.
+    @classmethod
+    def for_schemas(cls, beat_schemas):
+        schemas = {content_hash(beat_schema): beat_schema for beat_schema in beat_schemas}
+        hashes = list(schemas)
+        existing = set(db.session.scalars(select(cls.grid_hash).where(cls.grid_hash.in_(hashes))))
+        missing = [{'grid_hash': grid_hash, 'beat_schema': beat_schema, 'ref_count': 0, **compute_features(beat_schema)}
+                   for grid_hash, beat_schema in schemas.items() if grid_hash not in existing]
+        if missing:
+            created = db.session.execute(
+                sqlite_insert(cls).on_conflict_do_nothing(index_elements=['grid_hash'])
+                .returning(cls.id, cls.beat_schema), missing).all()
+            # rows inserted here bypass the ORM, so they are handed to ngrams.py to index at commit
+            db.session.info.setdefault('ngram_patterns', []).extend(tuple(row) for row in created)
+        patterns = {pattern.grid_hash: pattern for pattern in cls.query.filter(cls.grid_hash.in_(hashes))}
+        return [patterns[content_hash(beat_schema)] for beat_schema in beat_schemas]
+
+
+# rhythm n-gram postings: which beat_pattern ids in a block of ngrams.BLOCK_SIZE ids contain the n-gram,
+# as a bitmap; kept by the session hooks in ngrams.py
+class PatternNgram(db.Model):
+    ngram = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    block = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bits = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = {'sqlite_with_rowid': False}
+
+
+# a named swing/micro-timing/velocity feel (see grooves.py); beats reference it, and every edit bumps version
+class GrooveTemplate(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    swing = db.Column(db.Float, nullable=False, default=50.0)
+    micro_timing = db.Column(db.JSON, nullable=False, default=list)
+    velocity_offsets = db.Column(db.JSON, nullable=False, default=list)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "user_id": self.user_id,
+            "swing": self.swing,
+            "micro_timing": self.micro_timing,
+            "velocity_offsets": self.velocity_offsets,
+            "version": self.version
+        }
+
+
 class Beat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     beat_name = db.Column(db.String(50), nullable=False)
     # make it an Enum ()
     genre = db.Column(db.String(50), nullable=False)
     bpm = db.Column(db.Integer, nullable=False)
-    beat_schema = db.Column(db.JSON, nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    pattern_id = db.Column(db.Integer, db.ForeignKey('beat_pattern.id'), index=True)
+    pattern = db.relationship('BeatPattern', lazy='joined')
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # bumped on every edit, cell patches can be made conditional on it
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    groove_id = db.Column(db.Integer, db.ForeignKey('groove_template.id'))
+    groove = db.relationship('GrooveTemplate')
+
+    # the grid lives in the shared pattern; assigning one looks up its hash first
+    @property
+    def beat_schema(self):
+        return self.pattern.beat_schema if self.pattern is not None else None
+
+    @beat_schema.setter
+    def beat_schema(self, value):
+        self.pattern = BeatPattern.for_schema(value)
 
     def to_dict(self):
         return {"id": self.id,
@@ -87,12 +192,179 @@ class Beat(db.Model):
                 "genre": self.genre,
                 "bpm": self.bpm,
                 "beat_schema": self.beat_schema,
-                "user_id": self.user_id
+                "user_id": self.user_id,
+                "version": self.version,
+                "groove_id": self.groove_id
                 }
 
     def __repr__(self):
         return f'<Beat {self.beat_name}>'
 
 
+# beat counts per genre and bpm bucket, per user and over everyone (user_id 0); maintained by triggers in facets.py
+class BeatFacet(db.Model):
+    user_id = db.Column(db.Integer, primary_key=True)
+    facet = db.Column(db.String(10), primary_key=True)
+    value = db.Column(db.String(50), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+# queued audio renders, processed by `flask render-worker`; jobs for the same content_hash are rendered once
+class RenderJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    beat_id = db.Column(db.Integer, db.ForeignKey('beat.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # snapshot of what to render: beat_schema, bpm and render options
+    params = db.Column(db.JSON, nullable=False)
+    # queued, running, done, failed or cancelled
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    error = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    started_at = db.Column(db.DateTime)
+    # last progress report of the worker rendering it; running jobs that go quiet are requeued
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "beat_id": self.beat_id,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+# a user's drum kit; the preprocessed samples live in the sample bank under bank_name(content_hash)
+class Kit(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    @staticmethod
+    def bank_name(content_hash):
+        return f'kit-{content_hash}'
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "user_id": self.user_id,
+            "created_at": self.created_at.isoformat() if self.created_at else None
+        }
+
+
+# one scored play-along of a beat; append-only, folded into practice_progress by the trigger in practice.py
+class PracticeAttempt(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    beat_id = db.Column(db.Integer, db.ForeignKey('beat.id'), nullable=False, index=True)
+    beat_version = db.Column(db.Integer, nullable=False)
+    loops = db.Column(db.Integer, nullable=False, default=1)
+    hits = db.Column(db.Integer, nullable=False)
+    misses = db.Column(db.Integer, nullable=False)
+    extras = db.Column(db.Integer, nullable=False)
+    mean_error_ms = db.Column(db.Float)
+    mean_abs_error_ms = db.Column(db.Float)
+    score = db.Column(db.Float, nullable=False)
+    # the taps packed as practice.TAP_DTYPE records
+    taps = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "beat_id": self.beat_id,
+            "beat_version": self.beat_version,
+            "loops": self.loops,
+            "hits": self.hits,
+            "misses": self.misses,
+            "extras": self.extras,
+            "mean_error_ms": self.mean_error_ms,
+            "mean_abs_error_ms": self.mean_abs_error_ms,
+            "score": self.score,
+            "created_at": self.created_at.isoformat() if self.created_at else None
+        }
+
+
+# running practice totals per user and beat, beat_id 0 for all beats; maintained by the trigger in practice.py
+class PracticeProgress(db.Model):
+    user_id = db.Column(db.Integer, primary_key=True)
+    beat_id = db.Column(db.Integer, primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False)
+    hits = db.Column(db.Integer, nullable=False)
+    misses = db.Column(db.Integer, nullable=False)
+    extras = db.Column(db.Integer, nullable=False)
+    abs_error_sum_ms = db.Column(db.Float, nullable=False)
+    score_sum = db.Column(db.Float, nullable=False)
+    best_score = db.Column(db.Float, nullable=False)
+    # when best_score was first reached; the earlier of two equal scores ranks higher
+    best_at = db.Column(db.DateTime)
+    last_score = db.Column(db.Float, nullable=False)
+    last_attempt_at = db.Column(db.DateTime)
+
+    # leaderboard order, see leaderboards.py
+    __table_args__ = (db.Index('ix_practice_progress_rank', 'beat_id', db.text('best_score DESC'), 'best_at', 'user_id'),)
+
+
+# players per leaderboard and best score bucket (whole points or hundredths); maintained by triggers in leaderboards.py
+class LeaderboardBucket(db.Model):
+    beat_id = db.Column(db.Integer, primary_key=True)
+    # buckets per point: 1 or 100
+    scale = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+
+# append-only log of committed changes, written by the session hooks in events.py and tailed by GET /events
+class ChangeEvent(db.Model):
+    seq = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    # beat, text, page or page_block
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    # created, updated or deleted
+    action = db.Column(db.String(10), nullable=False)
+    page_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow, index=True)
+
+    # AUTOINCREMENT so sequence numbers are never reused after old events are pruned
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+# where the orphan collector stopped scanning each table, so runs resume instead of rescanning
+class GcCheckpoint(db.Model):
+    task = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
 
 
+# create_all() only creates missing tables, so add the columns and indexes introduced later to existing ones
+def upgrade_schema():
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = (f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} '
+                   f'{column.type.compile(db.engine.dialect)}')
+            if column.server_default is not None:
+                default = column.server_default.arg
+                ddl += f" DEFAULT '{default}'" if isinstance(default, str) else f' DEFAULT {default}'
+            db.session.execute(text(ddl))
+        db.session.commit()
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
@@ -0,0 +1,225 @@
+import json
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from sqlalchemy import event, text, bindparam
+from flask_sqlalchemy.session import Session
+from grid import INSTRUMENTS, decode_grid
+from models import BeatPattern, PENDING_RANGE
+
+# Inverted index for rhythm fragment search. Every instrument row of a grid (all bars in a row, hits as 1,
+# rests as 0) is cut into NGRAM-step windows, and each window is packed into one integer key:
+# instrument * 2**NGRAM + the window's bits. Rows are padded with rests so a fragment near the end still
+# starts a window. All-rest windows are not indexed.
+# Grids live on beat_pattern, shared by every beat with the same grid, so postings list pattern ids. A
+# posting list is stored as bitmaps of BLOCK_SIZE pattern ids, one pattern_ngram row per (key, block).
+# Deleted patterns leave their bits behind; candidates are always checked against the grid itself.
+# Patterns edited in place by cell PATCHes are only reindexed by compact_patterns, so until then every
+# pending pattern is a candidate.
+NGRAM = 8
+BLOCK_BITS = 12
+BLOCK_SIZE = 1 << BLOCK_BITS
+MAX_FRAGMENT = 64
+VERIFY_BATCH = 500
+
+
+def _window_bits(rows):
+    # rows: (..., steps) bool -> (..., steps) packed windows, padded at the end
+    padded = np.pad(rows, [(0, 0)] * (rows.ndim - 1) + [(0, NGRAM - 1)]).astype(np.int32)
+    bits = np.zeros(rows.shape, dtype=np.int32)
+    for k in range(NGRAM):
+        bits |= padded[..., k:k + rows.shape[-1]] << (NGRAM - 1 - k)
+    return bits
+
+
+# distinct keys of a batch of same-shaped grids (n, instruments, bars, steps): returns (grid index, key) arrays
+def grid_ngrams(grids):
+    n = grids.shape[0]
+    bits = _window_bits(grids.reshape(n, len(INSTRUMENTS), -1) > 0)
+    keys = (np.arange(len(INSTRUMENTS))[None, :, None] << NGRAM) | bits
+    index = np.broadcast_to(np.arange(n)[:, None, None], keys.shape)
+    hit = bits > 0
+    pairs = np.unique(index[hit].astype(np.int64) << 32 | keys[hit])
+    return pairs >> 32, pairs & 0xFFFFFFFF
+
+
+# [(pattern_id, beat_schema as dict or JSON)] -> (pattern ids, keys), grouping grids by shape
+def ngram_pairs(rows):
+    groups = {}
+    for pattern_id, beat_schema in rows:
+        if isinstance(beat_schema, str):
+            beat_schema = json.loads(beat_schema)
+        try:
+            grid = decode_grid(beat_schema)
+        except (KeyError, TypeError, ValueError):
+            continue
+        groups.setdefault(grid.shape, []).append((pattern_id, grid))
+    ids, keys = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for group in groups.values():
+        index, group_keys = grid_ngrams(np.stack([grid for _, grid in group]))
+        ids.append(np.array([pattern_id for pattern_id, _ in group], dtype=np.int64)[index])
+        keys.append(group_keys)
+    return np.concatenate(ids), np.concatenate(keys)
+
+
+# {(key, block): bitmap} for (pattern id, key) pairs
+def _bitmaps(ids, keys):
+    groups, group_index = np.unique(keys << 32 | ids >> BLOCK_BITS, return_inverse=True)
+    bitmaps = np.zeros((len(groups), BLOCK_SIZE // 8), dtype=np.uint8)
+    offsets = ids & (BLOCK_SIZE - 1)
+    np.bitwise_or.at(bitmaps, (group_index, offsets >> 3), (0x80 >> (offsets & 7)).astype(np.uint8))
+    return {(int(group >> 32), int(group & 0xFFFFFFFF)): bitmap for group, bitmap in zip(groups.tolist(), bitmaps)}
+
+
+_select_postings = text(
+    'SELECT ngram, block, bits FROM pattern_ngram WHERE ngram IN :keys AND block IN :blocks'
+).bindparams(bindparam('keys', expanding=True), bindparam('blocks', expanding=True))
+_write_postings = text('INSERT OR REPLACE INTO pattern_ngram (ngram, block, bits) VALUES (:ngram, :block, :bits)')
+
+
+# adds new patterns [(pattern_id, beat_schema)] to the index, merging into the stored bitmaps
+def index_patterns(connection, rows):
+    bitmaps = _bitmaps(*ngram_pairs(rows))
+    if not bitmaps:
+        return
+    keys = sorted({key for key, _ in bitmaps})
+    blocks = sorted({block for _, block in bitmaps})
+    for key, block, bits in connection.execute(_select_postings, {'keys': keys, 'blocks': blocks}):
+        if (key, block) in bitmaps:
+            bitmaps[key, block] = bitmaps[key, block] | np.frombuffer(bits, dtype=np.uint8)
+    connection.execute(_write_postings, [{'ngram': key, 'block': block, 'bits': bitmap.tobytes()}
+                                         for (key, block), bitmap in bitmaps.items()])
+
+
+# rebuilds the whole index from beat_pattern, one block of pattern ids at a time; yields patterns per block
+def rebuild_ngram_index(connection):
+    connection.exec_driver_sql('DELETE FROM pattern_ngram')
+    last_id = connection.exec_driver_sql('SELECT max(id) FROM beat_pattern').scalar() or 0
+    for block in range(last_id // BLOCK_SIZE + 1):
+        rows = connection.exec_driver_sql('SELECT id, json(beat_schema) FROM beat_pattern WHERE id >= ? AND id < ?',
+                                          (block * BLOCK_SIZE, (block + 1) * BLOCK_SIZE)).all()
+        bitmaps = _bitmaps(*ngram_pairs(rows))
+        if bitmaps:
+            connection.exec_driver_sql('INSERT INTO pattern_ngram (ngram, block, bits) VALUES (?, ?, ?)',
+                                       [(key, b, bitmap.tobytes()) for (key, b), bitmap in bitmaps.items()])
+        yield len(rows)
+
+
+def create_ngram_index(connection):
+    if connection.exec_driver_sql('SELECT 1 FROM pattern_ngram LIMIT 1').first() is None:
+        for _ in rebuild_ngram_index(connection):
+            pass
+
+
+# the index keys a fragment needs, as groups: a pattern must have some key of every group. A fragment of
+# at least NGRAM steps needs each of its own windows; a shorter one starts some window, so any of the
+# windows it is a prefix of will do.
+def fragment_keys(instrument, fragment):
+    hits = np.asarray(fragment) > 0
+    base = INSTRUMENTS.index(instrument) << NGRAM
+    if len(hits) >= NGRAM:
+        bits = _window_bits(hits)[:len(hits) - NGRAM + 1]
+        return [[base | int(b)] for b in np.unique(bits[bits > 0])]
+    free = NGRAM - len(hits)
+    prefix = int(_window_bits(hits)[0]) if len(hits) else 0
+    return [[base | prefix | tail for tail in range(1 << free) if prefix | tail]]
+
+
+def _candidates(connection, groups, blocks=None):
+    keys = sorted({key for group in groups for key in group})
+    sql = 'SELECT ngram, block, bits FROM pattern_ngram WHERE ngram IN :keys'
+    params = {'keys': keys}
+    if blocks is not None:
+        sql += ' AND block IN :blocks'
+        params['blocks'] = blocks
+    statement = text(sql).bindparams(*[bindparam(name, expanding=True) for name in params])
+    postings = {}
+    for key, block, bits in connection.execute(statement, params):
+        postings.setdefault(key, {})[block] = np.frombuffer(bits, dtype=np.uint8)
+
+    result = None
+    for group in groups:
+        merged = {}
+        for key in group:
+            for block, bitmap in postings.get(key, {}).items():
+                merged[block] = merged[block] | bitmap if block in merged else bitmap
+        if result is None:
+            result = merged
+        else:
+            result = {block: result[block] & bitmap for block, bitmap in merged.items() if block in result}
+    if not result:
+        return np.zeros(0, dtype=np.int64)
+    ordered = sorted(result)
+    bits = np.unpackbits(np.stack([result[block] for block in ordered]), axis=1)
+    block_index, offset = np.nonzero(bits)
+    return (np.array(ordered, dtype=np.int64)[block_index] << BLOCK_BITS) | offset
+
+
+# which of a batch of grids have the fragment somewhere in the instrument's row
+def _contains(grids, instrument, fragment):
+    rows = grids[:, INSTRUMENTS.index(instrument)].reshape(len(grids), -1) > 0
+    hits = np.asarray(fragment) > 0
+    if rows.shape[1] < len(hits):
+        return np.zeros(len(grids), dtype=bool)
+    return (sliding_window_view(rows, len(hits), axis=1) == hits).all(axis=2).any(axis=1)
+
+
+_select_pending = text(f'SELECT id FROM beat_pattern WHERE {PENDING_RANGE}')
+_select_grids = text('SELECT id, json(beat_schema) FROM beat_pattern WHERE id IN :ids').bindparams(
+    bindparam('ids', expanding=True))
+
+
+# ids of patterns containing the fragment, ascending; returns (ids, candidates checked). With pattern_ids
+# only those patterns are considered, and with a limit checking stops once that many have matched.
+def find_patterns(connection, instrument, fragment, pattern_ids=None, limit=None):
+    blocks = None
+    if pattern_ids is not None:
+        pattern_ids = np.unique(np.asarray(pattern_ids, dtype=np.int64))
+        blocks = np.unique(pattern_ids >> BLOCK_BITS).tolist()
+        if not blocks:
+            return [], 0
+    candidates = _candidates(connection, fragment_keys(instrument, fragment), blocks)
+    pending = np.array(connection.execute(_select_pending).scalars().all(), dtype=np.int64)
+    candidates = np.union1d(candidates, pending)
+    if pattern_ids is not None:
+        candidates = np.intersect1d(candidates, pattern_ids)
+
+    matches, checked = [], 0
+    size = VERIFY_BATCH if limit is None else min(VERIFY_BATCH, 2 * limit)
+    for start in range(0, len(candidates), size):
+        batch = candidates[start:start + size].tolist()
+        rows = connection.execute(_select_grids, {'ids': batch}).all()
+        checked += len(batch)
+        groups = {}
+        for pattern_id, beat_schema in rows:
+            try:
+                grid = decode_grid(json.loads(beat_schema))
+            except (KeyError, TypeError, ValueError):
+                continue
+            groups.setdefault(grid.shape, []).append((pattern_id, grid))
+        for group in groups.values():
+            found = _contains(np.stack([grid for _, grid in group]), instrument, fragment)
+            matches += [pattern_id for (pattern_id, _), match in zip(group, found) if match]
+        if limit is not None and len(matches) >= limit:
+            break
+    return sorted(matches), checked
+
+
+# new patterns are indexed in the transaction that creates them, whichever ORM path made them
+@event.listens_for(Session, 'after_flush')
+def _collect_patterns(session, flush_context):
+    created = [(obj.id, obj.beat_schema) for obj in session.new if isinstance(obj, BeatPattern)]
+    if created:
+        session.info.setdefault('ngram_patterns', []).extend(created)
+
+
+@event.listens_for(Session, 'before_commit')
+def _index_patterns(session):
+    session.flush()
+    rows = session.info.pop('ngram_patterns', None)
+    if rows:
+        index_patterns(session.connection(), rows)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_patterns(session, previous_transaction):
+    session.info.pop('ngram_patterns', None)
@@ -0,0 +1,105 @@
+import json
+import multiprocessing
+import os
+from sqlalchemy import inspect, text, bindparam
+from grid import content_hash
+from features import FEATURE_COLUMNS, features_for_rows, compute_features
+from ngrams import index_patterns
+from models import PENDING_RANGE
+
+# reference counting lives in SQL so ORM writes, bulk deletes and the orphan collector all keep it right
+PATTERN_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS beat_pattern_ref_ai AFTER INSERT ON beat WHEN new.pattern_id IS NOT NULL BEGIN
+        UPDATE beat_pattern SET ref_count = ref_count + 1 WHERE id = new.pattern_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS beat_pattern_ref_ad AFTER DELETE ON beat WHEN old.pattern_id IS NOT NULL BEGIN
+        UPDATE beat_pattern SET ref_count = ref_count - 1 WHERE id = old.pattern_id;
+        DELETE FROM beat_pattern WHERE id = old.pattern_id AND ref_count <= 0;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS beat_pattern_ref_au AFTER UPDATE OF pattern_id ON beat
+       WHEN old.pattern_id IS NOT new.pattern_id BEGIN
+        UPDATE beat_pattern SET ref_count = ref_count + 1 WHERE id = new.pattern_id;
+        UPDATE beat_pattern SET ref_count = ref_count - 1 WHERE id = old.pattern_id;
+        DELETE FROM beat_pattern WHERE id = old.pattern_id AND ref_count <= 0;
+    END""",
+]
+
+
+def create_pattern_triggers(connection):
+    for statement in PATTERN_TRIGGERS:
+        connection.exec_driver_sql(statement)
+
+
+# one-off move of grids stored on beat rows into beat_pattern, then drop the old column
+def migrate_beat_patterns(connection):
+    if 'beat_schema' not in {column['name'] for column in inspect(connection).get_columns('beat')}:
+        return
+    pattern_ids = dict(connection.execute(text('SELECT grid_hash, id FROM beat_pattern')).all())
+    rows = connection.execute(text('SELECT id, json(beat_schema) FROM beat WHERE pattern_id IS NULL')).all()
+    for beat_id, beat_schema in rows:
+        grid_hash = content_hash(json.loads(beat_schema))
+        if grid_hash not in pattern_ids:
+            pattern_ids[grid_hash] = connection.execute(text(
+                'INSERT INTO beat_pattern (grid_hash, beat_schema, ref_count) VALUES (:hash, :schema, 0) RETURNING id'),
+                {'hash': grid_hash, 'schema': beat_schema}).scalar()
+        connection.execute(text('UPDATE beat SET pattern_id = :pattern_id WHERE id = :id'),
+                           {'pattern_id': pattern_ids[grid_hash], 'id': beat_id})
+    connection.exec_driver_sql('ALTER TABLE beat DROP COLUMN beat_schema')
+
+
+
+# computes features for patterns created before they existed, spreading batches over a process pool;
+# yields the number of patterns written per committed batch
+def backfill_features(session, batch_size=500, workers=None):
+    ids = session.scalars(text(
+        'SELECT id FROM beat_pattern WHERE total_bars IS NULL AND NOT undecodable ORDER BY id')).all()
+    chunks = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+    select_rows = text('SELECT id, json(beat_schema) FROM beat_pattern WHERE id IN :ids').bindparams(
+        bindparam('ids', expanding=True))
+    columns = FEATURE_COLUMNS + ['undecodable']
+    write = text(f"UPDATE beat_pattern SET {', '.join(f'{c} = :{c}' for c in columns)} WHERE id = :id")
+
+    workers = workers or os.cpu_count()
+    in_flight = workers * 2
+    with multiprocessing.Pool(workers) as pool:
+        for start in range(0, len(chunks), in_flight):
+            batches = [session.execute(select_rows, {'ids': chunk}).all() for chunk in chunks[start:start + in_flight]]
+            session.rollback()
+            for results in pool.imap_unordered(features_for_rows, [[tuple(row) for row in rows] for rows in batches]):
+                session.execute(write, [{'id': pattern_id, **features} for pattern_id, features in results])
+                session.commit()
+                yield len(results)
+
+
+# gives patterns left pending by cell edits their real grid_hash: a grid that already has a pattern moves
+# its beats there (the triggers then free the pending one), any other gets its features and n-grams. A
+# pattern edited again meanwhile has a new pending hash and is left for the next run. Yields per batch.
+def compact_patterns(session, batch_size=500):
+    select_pending = text(f'SELECT id, grid_hash, json(beat_schema) FROM beat_pattern WHERE {PENDING_RANGE} '
+                          'AND id > :after ORDER BY id LIMIT :limit')
+    columns = FEATURE_COLUMNS + ['undecodable']
+    rehash = text(f"UPDATE beat_pattern SET grid_hash = :hash, {', '.join(f'{c} = :{c}' for c in columns)} "
+                  'WHERE id = :id AND grid_hash = :pending')
+    after = 0
+    while True:
+        rows = session.execute(select_pending, {'after': after, 'limit': batch_size}).all()
+        if not rows:
+            return
+        merged = 0
+        for pattern_id, pending, beat_schema in rows:
+            beat_schema = json.loads(beat_schema)
+            grid_hash = content_hash(beat_schema)
+            existing = session.execute(text('SELECT id FROM beat_pattern WHERE grid_hash = :hash'),
+                                       {'hash': grid_hash}).scalar()
+            if existing is not None:
+                merged += session.execute(text(
+                    'UPDATE beat SET pattern_id = :existing WHERE pattern_id = :id AND EXISTS '
+                    '(SELECT 1 FROM beat_pattern WHERE id = :id AND grid_hash = :pending)'),
+                    {'existing': existing, 'id': pattern_id, 'pending': pending}).rowcount
+            elif session.execute(rehash, {'id': pattern_id, 'pending': pending, 'hash': grid_hash,
+                                          **compute_features(beat_schema)}).rowcount:
+                index_patterns(session.connection(), [(pattern_id, beat_schema)])
+        session.commit()
+        after = rows[-1][0]
+        yield len(rows), merged
+
@@ -0,0 +1,71 @@
+import os
+import numpy as np
+from grid import content_hash
+from cache import LRUCache
+from render import render_chunks
+from samplebank import DEFAULT_KIT, load_kit
+
+# Waveform previews: (min, max) pairs over the rendered single loop of a beat. Level 0 of the pyramid
+# reduces BASE_BLOCK samples per pair and every further level halves the previous one, down to
+# MIN_LEVEL pairs. A pyramid is built once per content hash, kept on disk for every worker and in
+# an LRU per worker; any width is then cut from the nearest level at least that wide.
+BASE_BLOCK = 64
+MIN_LEVEL = 16
+MAX_WIDTH = 4096
+
+_pyramid_cache = LRUCache(maxsize=256)
+
+
+def _reduce(samples, block):
+    pad = -len(samples) % block
+    blocks = np.pad(samples, (0, pad), mode='edge').reshape(-1, block)
+    return np.stack([blocks.min(axis=1), blocks.max(axis=1)], axis=1)
+
+
+def build_pyramid(samples):
+    if not len(samples):
+        samples = np.zeros(1, dtype=np.float32)
+    levels = [_reduce(samples, BASE_BLOCK)]
+    while len(levels[-1]) > MIN_LEVEL:
+        level = levels[-1]
+        if len(level) % 2:
+            level = np.concatenate([level, level[-1:]])
+        pairs = level.reshape(-1, 2, 2)
+        levels.append(np.stack([pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)], axis=1))
+    return levels
+
+
+def _render_mono(beat_schema, bpm, voices, groove):
+    return np.concatenate(list(render_chunks(beat_schema, bpm, voices=voices, groove=groove))).mean(axis=1)
+
+
+def _load_or_build(path, beat_schema, bpm, bank_dir, kit, groove):
+    if os.path.exists(path):
+        with np.load(path) as stored:
+            return [stored[f'level{i}'] for i in range(len(stored.files))]
+    levels = build_pyramid(_render_mono(beat_schema, bpm, load_kit(bank_dir, kit), groove))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{os.getpid()}.part'
+    with open(partial, 'wb') as out:
+        np.savez(out, **{f'level{i}': level for i, level in enumerate(levels)})
+    os.replace(partial, path)
+    return levels
+
+
+# returns (hash, pyramid levels from finest to coarsest)
+def peak_pyramid(beat_schema, bpm, peaks_dir, bank_dir, kit=DEFAULT_KIT, groove=None):
+    if bpm <= 0:
+        raise ValueError('bpm must be positive')
+    key = content_hash(beat_schema, bpm, 'peaks', kit, *([groove] if groove else []))
+    path = os.path.join(peaks_dir, f'{key}.npz')
+    return key, _pyramid_cache.get_or_create(
+        key, lambda: _load_or_build(path, beat_schema, bpm, bank_dir, kit, groove))
+
+
+# `width` (min, max) pairs from the coarsest level that still has that many; capped at the finest level
+def peaks_for_width(levels, width):
+    level = next((level for level in reversed(levels) if len(level) >= width), levels[0])
+    if len(level) <= width:
+        return level
+    edges = np.linspace(0, len(level), width + 1).astype(np.int64)[:-1]
+    return np.stack([np.minimum.reduceat(level[:, 0], edges), np.maximum.reduceat(level[:, 1], edges)], axis=1)
@@ -0,0 +1,154 @@
+import numpy as np
+from sqlalchemy import text
+from grid import INSTRUMENTS
+
+# A practice attempt is a list of tap times (ms from the start of playback) per instrument, played along
+# `loops` passes of a beat. Each tap is matched to the nearest expected event of its instrument; taps
+# further than HIT_WINDOW_MS from every event, or beaten to an event by a closer tap, are extras, and
+# events nobody tapped are misses. Errors are signed, positive meaning late.
+HIT_WINDOW_MS = 150.0
+MAX_TAPS = 20000
+# taps as stored on an attempt, packed back to back like timeline events
+TAP_DTYPE = np.dtype([('time_ms', '<f4'), ('instrument', 'u1')])
+
+
+def pack_taps(taps):
+    packed = np.empty(sum(len(times) for times in taps.values()), dtype=TAP_DTYPE)
+    start = 0
+    for instrument, times in taps.items():
+        packed['time_ms'][start:start + len(times)] = times
+        packed['instrument'][start:start + len(times)] = INSTRUMENTS.index(instrument)
+        start += len(times)
+    return packed
+
+
+# Per expected event of the looped timeline: the matched tap's error in ms, NaN where it was missed.
+# Returns (expected instruments, errors, instruments of the extra taps). Events and taps of all
+# instruments are matched in one searchsorted, each instrument moved to its own stretch of the time axis.
+def align(events, duration, taps, loops=1):
+    passes = np.arange(loops)[:, None] * duration
+    expected = (events['time_ms'][None, :].astype(np.float64) + passes).ravel()
+    expected_instrument = np.tile(events['instrument'].astype(np.int64), loops)
+    stride = duration * loops + 4 * HIT_WINDOW_MS + max(float(taps['time_ms'].max(initial=0)), 0)
+    expected_key = expected_instrument * stride + expected
+    order = np.argsort(expected_key, kind='stable')
+    expected_key, expected, expected_instrument = expected_key[order], expected[order], expected_instrument[order]
+
+    tap_instrument = taps['instrument'].astype(np.int64)
+    tap_key = tap_instrument * stride + taps['time_ms'].astype(np.float64)
+    errors = np.full(len(expected), np.nan)
+    matched = np.zeros(len(taps), dtype=bool)
+    if len(expected) and len(taps):
+        right = np.minimum(np.searchsorted(expected_key, tap_key), len(expected) - 1)
+        left = np.maximum(right - 1, 0)
+        nearest = np.where(np.abs(tap_key - expected_key[left]) <= np.abs(tap_key - expected_key[right]), left, right)
+        error = tap_key - expected_key[nearest]
+        candidates = np.flatnonzero(np.abs(error) <= HIT_WINDOW_MS)
+        # the closest tap wins each event
+        candidates = candidates[np.lexsort((np.abs(error[candidates]), nearest[candidates]))]
+        _, first = np.unique(nearest[candidates], return_index=True)
+        winners = candidates[first]
+        errors[nearest[winners]] = error[winners]
+        matched[winners] = True
+    return expected_instrument, errors, tap_instrument[~matched]
+
+
+# summary statistics and a 0..100 score: every hit earns credit falling linearly from 1 on time to 0 at
+# the edge of the hit window, divided over the expected events plus the extra taps
+def score_attempt(expected_instrument, errors, extra_instrument):
+    hit = ~np.isnan(errors)
+    hit_errors = errors[hit]
+    expected, hits, extras = len(errors), int(hit.sum()), len(extra_instrument)
+    credit = np.maximum(1 - np.abs(hit_errors) / HIT_WINDOW_MS, 0).sum()
+    stats = {
+        'hits': hits,
+        'misses': expected - hits,
+        'extras': extras,
+        'mean_error_ms': round(float(hit_errors.mean()), 2) if hits else None,
+        'mean_abs_error_ms': round(float(np.abs(hit_errors).mean()), 2) if hits else None,
+        'std_error_ms': round(float(hit_errors.std()), 2) if hits else None,
+        'max_abs_error_ms': round(float(np.abs(hit_errors).max()), 2) if hits else None,
+        'score': round(float(100 * credit / max(expected + extras, 1)), 2),
+    }
+
+    counts = np.bincount(expected_instrument, minlength=len(INSTRUMENTS))
+    hit_counts = np.bincount(expected_instrument[hit], minlength=len(INSTRUMENTS))
+    error_sums = np.bincount(expected_instrument[hit], weights=hit_errors, minlength=len(INSTRUMENTS))
+    extra_counts = np.bincount(extra_instrument, minlength=len(INSTRUMENTS))
+    stats['instruments'] = {
+        instrument: {'hits': int(hit_counts[i]), 'misses': int(counts[i] - hit_counts[i]),
+                     'extras': int(extra_counts[i]),
+                     'mean_error_ms': round(float(error_sums[i] / hit_counts[i]), 2) if hit_counts[i] else None}
+        for i, instrument in enumerate(INSTRUMENTS) if counts[i] or extra_counts[i]}
+    return stats
+
+
+# practice_progress holds running totals per (user, beat); beat_id 0 is the user's total over all beats.
+# A trigger folds every new attempt in, so the dashboard reads one row per beat instead of the history.
+ALL_BEATS = 0
+
+
+def _fold(beat):
+    return (
+        'INSERT INTO practice_progress (user_id, beat_id, attempts, hits, misses, extras, abs_error_sum_ms, '
+        'score_sum, best_score, best_at, last_score, last_attempt_at) '
+        f'VALUES (new.user_id, {beat}, 1, new.hits, new.misses, new.extras, '
+        'coalesce(new.mean_abs_error_ms * new.hits, 0), new.score, new.score, new.created_at, new.score, new.created_at) '
+        'ON CONFLICT (user_id, beat_id) DO UPDATE SET attempts = attempts + 1, hits = hits + excluded.hits, '
+        'misses = misses + excluded.misses, extras = extras + excluded.extras, '
+        'abs_error_sum_ms = abs_error_sum_ms + excluded.abs_error_sum_ms, score_sum = score_sum + excluded.score_sum, '
+        'best_score = max(best_score, excluded.best_score), '
+        'best_at = CASE WHEN excluded.best_score > best_score THEN excluded.best_at ELSE best_at END, '
+        'last_score = excluded.last_score, last_attempt_at = excluded.last_attempt_at; ')
+
+
+PROGRESS_TRIGGERS = {
+    'practice_progress_ai': f'AFTER INSERT ON practice_attempt BEGIN {_fold("new.beat_id")}{_fold(ALL_BEATS)}END',
+    # a deleted user leaves the leaderboards at once; their attempts wait for gc-orphans
+    'practice_progress_user_ad': 'AFTER DELETE ON user BEGIN DELETE FROM practice_progress WHERE user_id = old.id; END',
+}
+
+
+# creates the triggers, replacing any whose stored definition is out of date, and fills best_at on
+# progress rows folded before it existed from the attempt that set the best score
+def create_progress_triggers(connection):
+    existing = dict(connection.exec_driver_sql("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").all())
+    for name, body in PROGRESS_TRIGGERS.items():
+        if name in existing and not existing[name].endswith(body):
+            connection.exec_driver_sql(f'DROP TRIGGER {name}')
+        connection.exec_driver_sql(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+    connection.exec_driver_sql(
+        'UPDATE practice_progress AS p SET best_at = coalesce('
+        '(SELECT min(a.created_at) FROM practice_attempt a WHERE a.user_id = p.user_id '
+        f'AND (p.beat_id = {ALL_BEATS} OR a.beat_id = p.beat_id) AND a.score = p.best_score), p.last_attempt_at) '
+        'WHERE best_at IS NULL')
+
+
+def _progress(row):
+    attempts, hits, misses, extras, abs_error_sum, score_sum, best, last, last_at = row
+    return {
+        'attempts': attempts,
+        'hits': hits,
+        'misses': misses,
+        'extras': extras,
+        'accuracy': round(hits / (hits + misses), 4) if hits + misses else None,
+        'mean_abs_error_ms': round(abs_error_sum / hits, 2) if hits else None,
+        'mean_score': round(score_sum / attempts, 2),
+        'best_score': best,
+        'last_score': last,
+        'last_attempt_at': last_at,
+    }
+
+
+def progress_summary(connection, user_id):
+    rows = connection.execute(text(
+        'SELECT beat_id, attempts, hits, misses, extras, abs_error_sum_ms, score_sum, best_score, last_score, '
+        'last_attempt_at FROM practice_progress WHERE user_id = :user_id ORDER BY last_attempt_at DESC'),
+        {'user_id': user_id})
+    result = {'overall': None, 'beats': []}
+    for beat_id, *row in rows:
+        if beat_id == ALL_BEATS:
+            result['overall'] = _progress(row)
+        else:
+            result['beats'].append({'beat_id': beat_id, **_progress(row)})
+    return result
@@ -0,0 +1,114 @@
+import wave
+import numpy as np
+from grid import INSTRUMENTS, decode_grid, velocities, step_seconds
+from effects import channel_gains, shape_voices, apply_bus, tail_samples
+from grooves import groove_steps
+
+SAMPLE_RATE = 44100
+MASTER_GAIN = 0.8
+# bounds the (hits x voice length) index arrays built while placing voices
+STAMP_BATCH = 1 << 21
+
+_voices = {}
+
+
+def _envelope(seconds, decay):
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return t, np.exp(-t / decay)
+
+
+def _synth_voice(instrument):
+    rng = np.random.default_rng(INSTRUMENTS.index(instrument))
+    if instrument == 'kick':
+        t, env = _envelope(0.5, 0.12)
+        # pitch drops from 150 Hz to 50 Hz
+        phase = 2 * np.pi * (50 * t + 100 * 0.05 * (1 - np.exp(-t / 0.05)))
+        return np.sin(phase) * env
+    if instrument == 'snare':
+        t, env = _envelope(0.3, 0.06)
+        return 0.6 * rng.uniform(-1, 1, len(t)) * env + 0.4 * np.sin(2 * np.pi * 190 * t) * env
+    if instrument == 'high-hat':
+        t, env = _envelope(0.12, 0.02)
+        noise = rng.uniform(-1, 1, len(t))
+        return 0.5 * np.diff(noise, prepend=0) * env
+    t, env = _envelope(0.4, 0.15)
+    return np.sin(2 * np.pi * {'tom1': 180, 'tom2': 120}[instrument] * t) * env
+
+
+# one mono float32 voice per instrument, synthesized once per process; the source of the default
+# kit in the sample bank, and what renders fall back to without one
+def drum_voices():
+    if not _voices:
+        _voices.update({instrument: _synth_voice(instrument).astype(np.float32) for instrument in INSTRUMENTS})
+    return _voices
+
+
+# adds the voice at every offset into the (2, samples) mix, scaled per hit and channel by weights (hits, 2),
+# as one bincount per channel and batch of hits
+def _stamp(mix, offsets, weights, voice):
+    n = mix.shape[1]
+    batch = max(STAMP_BATCH // max(len(voice), 1), 1)
+    span = np.arange(len(voice))
+    centred = np.array_equal(weights[:, 0], weights[:, 1])
+    for start in range(0, len(offsets), batch):
+        positions = (offsets[start:start + batch, None] + span).ravel()
+        stamped = None
+        for channel in range(2):
+            if stamped is None or not centred:
+                scaled = (weights[start:start + batch, channel, None] * voice).ravel()
+                stamped = np.bincount(positions, scaled, minlength=n)[:n]
+            mix[channel] += stamped
+
+
+# one pass of the beat as (samples, 2) float32, plus the tail ringing past its end
+# (see effects.py for `effects` and grooves.py for `groove`)
+def render_loop(beat_schema, bpm, voices=None, effects=None, groove=None):
+    voices = shape_voices(voices or drum_voices(), effects, SAMPLE_RATE)
+    grid = decode_grid(beat_schema)
+    positions, hits = groove_steps(velocities(grid.reshape(len(INSTRUMENTS), -1)), groove, grid.shape[2])
+    hits = hits / 127.0
+    seconds_per_step = step_seconds(bpm, grid.shape[2]) if grid.shape[2] else 0
+    length = int(round(hits.shape[1] * seconds_per_step * SAMPLE_RATE))
+    offsets = np.rint(positions * seconds_per_step * SAMPLE_RATE).astype(np.int64)
+
+    tail = max(len(voice) for voice in voices.values()) + tail_samples(effects, SAMPLE_RATE)
+    gains = channel_gains(effects)
+    mix = np.zeros((2, length + tail), dtype=np.float64)
+    for i, instrument in enumerate(INSTRUMENTS):
+        steps = np.flatnonzero(hits[i])
+        if len(steps):
+            _stamp(mix, offsets[steps], hits[i][steps, None] * gains[i], voices[instrument])
+    if effects:
+        mix = apply_bus(mix, effects, SAMPLE_RATE)
+    stereo = np.ascontiguousarray((mix * MASTER_GAIN).T, dtype=np.float32)
+    return stereo[:length], stereo[length:]
+
+
+# yields the beat repeated `loops` times as (samples, 2) chunks, one loop per chunk, ending with the last tail
+def render_chunks(beat_schema, bpm, loops=1, voices=None, effects=None, groove=None):
+    body, tail = render_loop(beat_schema, bpm, voices, effects, groove)
+    carry = np.zeros_like(tail)
+    for _ in range(loops):
+        chunk = body.copy()
+        overlap = min(len(carry), len(chunk))
+        chunk[:overlap] += carry[:overlap]
+        carry = np.concatenate([carry[overlap:], np.zeros((overlap, 2), dtype=np.float32)]) + tail
+        yield chunk
+    yield carry
+
+
+def to_pcm16(chunk):
+    return (np.clip(chunk, -1, 1) * 32767).astype('<i2').tobytes()
+
+
+# writes chunks to a 16-bit stereo WAV as they come; on_chunk(i) may return False to stop early
+def write_wav(path, chunks, on_chunk=None):
+    with wave.open(path, 'wb') as out:
+        out.setnchannels(2)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        for i, chunk in enumerate(chunks):
+            out.writeframes(to_pcm16(chunk))
+            if on_chunk is not None and on_chunk(i) is False:
+                return False
+    return True
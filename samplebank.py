@@ -0,0 +1,72 @@
+import os
+import shutil
+import numpy as np
+from grid import INSTRUMENTS
+from render import SAMPLE_RATE, drum_voices
+from cache import LRUCache
+
+# A kit is a directory under the bank holding one mono float32 .npy per instrument at SAMPLE_RATE,
+# written once and never modified. Workers and render processes map the files read-only, so every
+# process shares the same page-cache copy and loading a kit parses nothing.
+DEFAULT_KIT = 'default-v1'
+
+# user kits come and go, so only the most recently used ones stay mapped
+_kits = LRUCache(maxsize=32)
+
+
+def kit_dir(bank_dir, kit):
+    return os.path.join(bank_dir, kit)
+
+
+def has_kit(bank_dir, kit):
+    return all(os.path.exists(os.path.join(kit_dir(bank_dir, kit), f'{instrument}.npy')) for instrument in INSTRUMENTS)
+
+
+# band-limited resampling through the spectrum; fine for one-shot drum samples of a few seconds
+def resample(samples, rate, target=SAMPLE_RATE):
+    samples = np.asarray(samples, dtype=np.float64)
+    if rate == target or not len(samples):
+        return samples.astype(np.float32)
+    length = max(int(round(len(samples) * target / rate)), 1)
+    return (np.fft.irfft(np.fft.rfft(samples), length) * (length / len(samples))).astype(np.float32)
+
+
+# sources maps every instrument to (samples, sample_rate). The kit is written to a scratch directory
+# and renamed into place, so readers never see half a kit; if another process got there first its
+# copy is kept.
+def write_kit(bank_dir, kit, sources):
+    target = kit_dir(bank_dir, kit)
+    if has_kit(bank_dir, kit):
+        return target
+    scratch = f'{target}.{os.getpid()}.tmp'
+    os.makedirs(scratch, exist_ok=True)
+    try:
+        for instrument in INSTRUMENTS:
+            samples, rate = sources[instrument]
+            np.save(os.path.join(scratch, f'{instrument}.npy'), resample(samples, rate))
+        try:
+            os.rename(scratch, target)
+        except OSError:
+            if not has_kit(bank_dir, kit):
+                raise
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return target
+
+
+def ensure_default_kit(bank_dir):
+    if not has_kit(bank_dir, DEFAULT_KIT):
+        os.makedirs(bank_dir, exist_ok=True)
+        write_kit(bank_dir, DEFAULT_KIT, {instrument: (voice, SAMPLE_RATE)
+                                          for instrument, voice in drum_voices().items()})
+
+
+# {instrument: read-only memmap}, mapped once per process
+def load_kit(bank_dir, kit=DEFAULT_KIT):
+    def open_kit():
+        if not has_kit(bank_dir, kit):
+            raise LookupError(f'Kit {kit} is not in the sample bank')
+        return {instrument: np.load(os.path.join(kit_dir(bank_dir, kit), f'{instrument}.npy'), mmap_mode='r')
+                for instrument in INSTRUMENTS}
+
+    return _kits.get_or_create((bank_dir, kit), open_kit)
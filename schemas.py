@@ -1,4 +1,13 @@
-from marshmallow import Schema, fields, validate, validates, ValidationError
+from marshmallow import Schema, fields, validate, validates, validates_schema, ValidationError
+from blocks import BLOCK_RESOLVERS
+from grid import INSTRUMENTS
+from transforms import TRANSFORMS
+from practice import MAX_TAPS
+
+
+def validate_block_type(value):
+    if value not in BLOCK_RESOLVERS:
+        raise ValidationError(f'block_type must be one of: {sorted(BLOCK_RESOLVERS)}')
 
 
 class UserSchema(Schema):
@@ -17,12 +26,29 @@ class TextSchema(Schema):
 
 class PageBlocksSchema(Schema):
     id = fields.Int(dump_only=True)
-    block_type = fields.Str(required=True, validate=validate.Length(min=1, max=50))
+    block_type = fields.Str(required=True, validate=[validate.Length(min=1, max=50), validate_block_type])
     block_id = fields.Int(required=True)
-    position = fields.Int(required=True)
+    position = fields.Int()
+    after_id = fields.Int(load_only=True, allow_none=True)
     page_id = fields.Int(required=True)
 
 
+class PageBlockItemSchema(Schema):
+    id = fields.Int(load_default=None)
+    block_type = fields.Str(required=True, validate=[validate.Length(min=1, max=50), validate_block_type])
+    block_id = fields.Int(required=True)
+
+    # every existing block may appear once in the list; a repeated id would update the same row twice
+    @validates_schema(pass_many=True)
+    def validate_unique_ids(self, data, many, **kwargs):
+        if not many:
+            return
+        ids = [item['id'] for item in data if item.get('id') is not None]
+        repeated = sorted({block_id for block_id in ids if ids.count(block_id) > 1})
+        if repeated:
+            raise ValidationError(f'block ids must be unique, repeated: {repeated}', 'id')
+
+
 class PageSchema(Schema):
     id = fields.Int(dump_only=True)
     title = fields.Str(required=True, validate=validate.Length(min=1, max=100))
@@ -36,6 +62,8 @@ class BeatSchema(Schema):
     bpm = fields.Int(required=True)
     beat_schema = fields.Dict(required=True)
     user_id = fields.Int(required=True)
+    version = fields.Int(dump_only=True)
+    groove_id = fields.Int(allow_none=True, load_default=None)
 
     @validates('beat_schema')
     def validate_beat_schema(self, value):
@@ -52,6 +80,104 @@ class BeatSchema(Schema):
                 for step in beat:
                     if not isinstance(step, int):
                         raise ValidationError(f'{instrument} must be a list of lists of integers.')
+                    if not 0 <= step <= 127:
+                        raise ValidationError(f'{instrument} steps must be between 0 and 127.')
+
+
+class BeatPatchSchema(Schema):
+    version = fields.Int(load_default=None)
+    # compact (instrument, bar, step, value) edits
+    cells = fields.List(fields.Tuple((
+        fields.Str(validate=validate.OneOf(INSTRUMENTS)),
+        fields.Int(validate=validate.Range(min=0)),
+        fields.Int(validate=validate.Range(min=0)),
+        fields.Int(validate=validate.Range(min=0, max=127)),
+    )), required=True, validate=validate.Length(min=1))
+
+
+class TransformSchema(Schema):
+    op = fields.Str(required=True, validate=validate.OneOf(list(TRANSFORMS)))
+    steps = fields.Int()
+    instruments = fields.List(fields.Str(validate=validate.OneOf(INSTRUMENTS)))
+    steps_per_bar = fields.Int(validate=validate.Range(min=1))
+    velocity = fields.Int(validate=validate.Range(min=0, max=127))
+    timing = fields.Float(validate=validate.Range(min=0, max=1))
+    seed = fields.Int()
+
+
+class BeatTransformSchema(Schema):
+    transforms = fields.List(fields.Nested(TransformSchema), required=True, validate=validate.Length(min=1))
+    # store the results as new beats instead of only previewing them
+    save = fields.Bool(load_default=False)
+
+
+class BatchTransformSchema(BeatTransformSchema):
+    ids = fields.List(fields.Int(), required=True, validate=validate.Length(min=1, max=500))
+
+
+class GrooveSchema(Schema):
+    id = fields.Int(dump_only=True)
+    name = fields.Str(required=True, validate=validate.Length(min=1, max=50))
+    user_id = fields.Int(dump_only=True)
+    swing = fields.Float(load_default=50.0, validate=validate.Range(min=50, max=75))
+    micro_timing = fields.List(fields.Float(validate=validate.Range(min=-0.5, max=0.5)), load_default=list,
+                               validate=validate.Length(max=64))
+    velocity_offsets = fields.List(fields.Int(validate=validate.Range(min=-127, max=127)), load_default=list,
+                                   validate=validate.Length(max=64))
+    version = fields.Int(dump_only=True)
+
+
+def validate_instrument_keys(value):
+    unknown = sorted(set(value) - set(INSTRUMENTS))
+    if unknown:
+        raise ValidationError(f'unknown instruments: {unknown}')
+
+
+class EqSchema(Schema):
+    low_db = fields.Float(load_default=0.0, validate=validate.Range(min=-24, max=24))
+    mid_db = fields.Float(load_default=0.0, validate=validate.Range(min=-24, max=24))
+    high_db = fields.Float(load_default=0.0, validate=validate.Range(min=-24, max=24))
+
+
+class CompressorSchema(Schema):
+    threshold_db = fields.Float(load_default=-18.0, validate=validate.Range(min=-60, max=0))
+    ratio = fields.Float(load_default=4.0, validate=validate.Range(min=1, max=20))
+    attack_ms = fields.Float(load_default=10.0, validate=validate.Range(min=0.1, max=200))
+    release_ms = fields.Float(load_default=120.0, validate=validate.Range(min=1, max=2000))
+    makeup_db = fields.Float(load_default=0.0, validate=validate.Range(min=0, max=24))
+
+
+class ReverbSchema(Schema):
+    decay = fields.Float(load_default=1.2, validate=validate.Range(min=0.1, max=5))
+    mix = fields.Float(load_default=0.25, validate=validate.Range(min=0, max=1))
+
+
+class EffectsSchema(Schema):
+    gain = fields.Dict(keys=fields.Str(), values=fields.Float(validate=validate.Range(min=-60, max=12)),
+                       validate=validate_instrument_keys)
+    pan = fields.Dict(keys=fields.Str(), values=fields.Float(validate=validate.Range(min=-1, max=1)),
+                      validate=validate_instrument_keys)
+    eq = fields.Nested(EqSchema)
+    compressor = fields.Nested(CompressorSchema)
+    reverb = fields.Nested(ReverbSchema)
+
+
+class RenderOptionsSchema(Schema):
+    loops = fields.Int(load_default=1, validate=validate.Range(min=1, max=256))
+    # one of the user's kits instead of the default sounds
+    kit_id = fields.Int(load_default=None)
+    # a groove template other than the beat's own, 0 for straight time
+    groove_id = fields.Int(load_default=None)
+    effects = fields.Nested(EffectsSchema)
 
 
+class AttemptSchema(Schema):
+    # {instrument: [tap time in ms from the start of playback, ...]}
+    taps = fields.Dict(keys=fields.Str(), values=fields.List(fields.Float(validate=validate.Range(min=0))),
+                       required=True, validate=validate_instrument_keys)
+    loops = fields.Int(load_default=1, validate=validate.Range(min=1, max=256))
 
+    @validates('taps')
+    def validate_tap_count(self, value):
+        if sum(len(times) for times in value.values()) > MAX_TAPS:
+            raise ValidationError(f'at most {MAX_TAPS} taps per attempt')
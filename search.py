@@ -0,0 +1,94 @@
+from sqlalchemy import text
+from models import db
+
+# external-content FTS5 indexes over the searchable columns; user_id is indexed too so MATCH does the user scoping.
+# Columns stored as CompressedText are read through plain_text(), via a view for the index's own reads.
+SEARCH_INDEXES = {
+    'text_fts': ('text', ['content', 'user_id'], ['content']),
+    'beat_fts': ('beat', ['beat_name', 'genre', 'user_id'], []),
+    'page_fts': ('page', ['title', 'user_id'], []),
+}
+
+MAX_LIMIT = 100
+
+
+def _fts_definition(fts):
+    table, columns, compressed = SEARCH_INDEXES[fts]
+    source = f'{fts}_source' if compressed else table
+    return f"fts5({', '.join(columns)}, content='{source}', content_rowid='id')"
+
+
+def search_ddl():
+    statements = []
+    for fts, (table, columns, compressed) in SEARCH_INDEXES.items():
+        cols = ', '.join(columns)
+        new = ', '.join(f'plain_text(new.{c})' if c in compressed else f'new.{c}' for c in columns)
+        old = ', '.join(f'plain_text(old.{c})' if c in compressed else f'old.{c}' for c in columns)
+        if compressed:
+            plain = ', '.join(f'plain_text({c}) AS {c}' if c in compressed else c for c in columns)
+            statements.append(f"CREATE VIEW IF NOT EXISTS {fts}_source AS SELECT id, {plain} FROM {table}")
+        statements += [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING {_fts_definition(fts)}",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old}); "
+            f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new}); END",
+        ]
+    return statements
+
+
+# creates the indexes and triggers, and (re)builds an index from its table when it is new or its definition changed
+def create_search_index(connection):
+    existing = {name: sql for name, sql in connection.exec_driver_sql(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name LIKE '%_fts'")}
+    stale = [fts for fts in SEARCH_INDEXES if fts in existing and not existing[fts].endswith(_fts_definition(fts))]
+    for fts in stale:
+        for trigger in ('ai', 'ad', 'au'):
+            connection.exec_driver_sql(f'DROP TRIGGER IF EXISTS {fts}_{trigger}')
+        connection.exec_driver_sql(f'DROP TABLE {fts}')
+        connection.exec_driver_sql(f'DROP VIEW IF EXISTS {fts}_source')
+
+    for statement in search_ddl():
+        connection.exec_driver_sql(statement)
+    for fts in SEARCH_INDEXES:
+        if fts not in existing or fts in stale:
+            connection.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+# turn free user input into an FTS5 expression: every word must match, the last one as a prefix
+def build_match(query):
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if not terms:
+        return None
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+SEARCH_SQL = text("""
+    SELECT kind, id, title, snippet, score FROM (
+        SELECT 'text' AS kind, rowid AS id, NULL AS title,
+               snippet(text_fts, 0, '[', ']', '...', 12) AS snippet, bm25(text_fts, 1.0, 0.0) AS score
+        FROM text_fts WHERE text_fts MATCH 'user_id : "' || :user_id || '" AND content : (' || :match || ')'
+        UNION ALL
+        SELECT 'beat', rowid, beat_name, snippet(beat_fts, -1, '[', ']', '...', 12), bm25(beat_fts, 2.0, 1.0, 0.0)
+        FROM beat_fts WHERE beat_fts MATCH 'user_id : "' || :user_id || '" AND {beat_name genre} : (' || :match || ')'
+        UNION ALL
+        SELECT 'page', rowid, title, NULL, bm25(page_fts, 1.0, 0.0)
+        FROM page_fts WHERE page_fts MATCH 'user_id : "' || :user_id || '" AND title : (' || :match || ')'
+    )
+    ORDER BY score, kind, id
+    LIMIT :limit OFFSET :offset
+""")
+
+
+def search(user_id, query, limit=20, offset=0):
+    match = build_match(query)
+    if match is None:
+        return []
+    rows = db.session.execute(SEARCH_SQL, {'user_id': int(user_id), 'match': match,
+                                           'limit': min(limit, MAX_LIMIT), 'offset': offset})
+    return [{"type": row.kind, "id": row.id, "title": row.title, "snippet": row.snippet, "score": row.score}
+            for row in rows]
@@ -0,0 +1,45 @@
+import numpy as np
+from grid import INSTRUMENTS, BEATS_PER_BAR, decode_grid, velocities, step_seconds, content_hash
+from cache import LRUCache
+from grooves import groove_steps
+
+# one playback event: when (ms from the start), which instrument (index into INSTRUMENTS) and how loud.
+# The binary form of a timeline is these records packed back to back, little-endian, struct format '<fBB'.
+EVENT_DTYPE = np.dtype([('time_ms', '<f4'), ('instrument', 'u1'), ('velocity', 'u1')])
+EVENT_STRUCT = '<fBB'
+
+_timeline_cache = LRUCache(maxsize=1024)
+
+
+def compute_timeline(beat_schema, bpm, groove=None):
+    grid = decode_grid(beat_schema)
+    positions, hits = groove_steps(velocities(grid.reshape(len(INSTRUMENTS), -1)), groove, grid.shape[2])
+    instrument, step = np.nonzero(hits)
+    seconds_per_step = step_seconds(bpm, grid.shape[2]) if grid.shape[2] else 0
+    times = positions[step] * (seconds_per_step * 1000)
+    order = np.lexsort((instrument, times))
+    events = np.empty(len(order), dtype=EVENT_DTYPE)
+    events['time_ms'] = times[order]
+    events['instrument'] = instrument[order]
+    events['velocity'] = hits[instrument[order], step[order]]
+    # shared between requests through the cache
+    events.flags.writeable = False
+    return events
+
+
+def duration_ms(beat_schema, bpm):
+    return len(beat_schema[INSTRUMENTS[0]]) * BEATS_PER_BAR * 60000 / bpm
+
+
+# sorted event array of a beat, cached by content hash, so an edited grid, bpm or groove gets a new entry;
+# returns (hash, array)
+def beat_timeline(beat_schema, bpm, groove=None):
+    if bpm <= 0:
+        raise ValueError('bpm must be positive')
+    key = content_hash(beat_schema, bpm, 'timeline', *([groove] if groove else []))
+    return key, _timeline_cache.get_or_create(key, lambda: compute_timeline(beat_schema, bpm, groove))
+
+
+def timeline_json(events):
+    return [[round(float(time_ms), 3), int(instrument), int(velocity)]
+            for time_ms, instrument, velocity in events.tolist()]
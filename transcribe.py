@@ -0,0 +1,184 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from grid import INSTRUMENTS, BEATS_PER_BAR, encode_grid
+from kits import iter_wav
+from render import SAMPLE_RATE, drum_voices
+
+# Recording -> beat_schema in one pass over the audio: WAV chunks go through a streaming STFT that keeps
+# only a few numbers per 10 ms frame (the spectral flux and BAND_COUNT band magnitudes), so memory grows
+# with the length of the recording in frames, not samples. Onsets, tempo, grid phase and instruments are
+# then worked out from those frame features.
+MAX_SECONDS = 600
+MAX_TRANSCRIBE_UPLOAD = 200 * 1024 * 1024
+MAX_BARS = 64
+HOP_SECONDS = 0.01
+MIN_BPM, MAX_BPM = 60, 200
+# log-spaced bands between these frequencies describe the spectrum of each hit
+BAND_COUNT = 24
+BAND_LOW_HZ, BAND_HIGH_HZ = 40, 16000
+MEDIAN_FRAMES = 10
+PEAK_FRAMES = 3
+THRESHOLD = 0.05
+# an instrument counts as played at an onset when it explains at least this share of the onset's band energy
+MIN_SHARE = 0.2
+FIT_ITERATIONS = 200
+
+_templates = {}
+
+
+# (BAND_COUNT, bins) matrix averaging an rfft magnitude over each band
+def _band_matrix(freqs):
+    edges = np.geomspace(BAND_LOW_HZ, BAND_HIGH_HZ, BAND_COUNT + 1)
+    masks = ((freqs >= edges[:-1, None]) & (freqs < edges[1:, None])).astype(np.float64)
+    return masks / np.maximum(masks.sum(axis=1, keepdims=True), 1)
+
+
+# (instruments, BAND_COUNT) band spectrum of each default voice's attack, each summing to 1
+def band_templates(rate, frame):
+    key = (rate, frame)
+    if key not in _templates:
+        size = int(round(frame * SAMPLE_RATE / rate))
+        voices = drum_voices()
+        # the hit starts mid-frame, as it does in the frame band_levels() looks at
+        attacks = np.zeros((len(INSTRUMENTS), size))
+        for i, instrument in enumerate(INSTRUMENTS):
+            attack = voices[instrument][:size - size // 2]
+            attacks[i, size // 2:size // 2 + len(attack)] = attack
+        spectrum = np.abs(np.fft.rfft(attacks * np.hanning(size), axis=1))
+        bands = spectrum @ _band_matrix(np.fft.rfftfreq(size, 1 / SAMPLE_RATE)).T
+        _templates[key] = bands / bands.sum(axis=1, keepdims=True)
+    return _templates[key]
+
+
+# Streaming STFT over the recording. Per 10 ms hop it keeps the spectral flux (mean rise of the
+# log magnitude, for finding onsets) and the linear magnitude in each band (for telling the
+# instruments apart, as linear magnitudes of simultaneous hits roughly add up).
+class _SpectralFlux:
+    def __init__(self, rate):
+        self.rate = rate
+        self.hop = max(int(round(rate * HOP_SECONDS)), 1)
+        self.frame = 1 << (4 * self.hop - 1).bit_length()
+        self.window = np.hanning(self.frame)
+        self.bands = _band_matrix(np.fft.rfftfreq(self.frame, 1 / rate))
+        self.pending = np.zeros(self.frame - self.hop)
+        self.previous = np.zeros((1, self.frame // 2 + 1))
+        self.flux, self.band_magnitude = [], []
+
+    def feed(self, samples):
+        data = np.concatenate([self.pending, samples])
+        count = (len(data) - self.frame) // self.hop + 1
+        if count <= 0:
+            self.pending = data
+            return
+        frames = sliding_window_view(data, self.frame)[::self.hop][:count]
+        magnitude = np.abs(np.fft.rfft(frames * self.window))
+        before = np.concatenate([self.previous, magnitude[:-1]])
+        self.flux.append(np.maximum(np.log1p(100 * magnitude) - np.log1p(100 * before), 0).mean(axis=1))
+        self.band_magnitude.append(magnitude @ self.bands.T)
+        self.previous = magnitude[-1:]
+        self.pending = data[count * self.hop:]
+
+    def result(self):
+        if not self.flux:
+            return np.zeros(0), np.zeros((0, BAND_COUNT))
+        return np.concatenate(self.flux), np.concatenate(self.band_magnitude)
+
+
+# how much each band rose at each onset: from the frame before the onset to the frame the hit's
+# attack is centred in
+def band_levels(band_magnitude, onsets, frame, hop):
+    centred = np.minimum(onsets + max(int(round(frame / (2 * hop) - 1)), 0), len(band_magnitude) - 1)
+    before = band_magnitude[np.maximum(onsets - 1, 0)] * (onsets > 0)[:, None]
+    return np.maximum(band_magnitude[centred] - before, 0)
+
+
+def _sliding(values, radius, reduce):
+    padded = np.pad(values, radius)
+    return reduce(sliding_window_view(padded, 2 * radius + 1), axis=1)
+
+
+# frames where the flux is a local maximum and clearly above its running median
+def detect_onsets(flux):
+    if not len(flux) or flux.max() <= 0:
+        return np.zeros(0, dtype=np.int64)
+    flux = flux / flux.max()
+    local_max = flux == _sliding(flux, PEAK_FRAMES, np.max)
+    return np.flatnonzero(local_max & (flux > _sliding(flux, MEDIAN_FRAMES, np.median) + THRESHOLD))
+
+
+# the lag with the strongest flux autocorrelation among MIN_BPM..MAX_BPM, weighted towards ~120 bpm so a
+# tempo is not mistaken for its double or half
+def estimate_tempo(flux, fps):
+    envelope = flux - flux.mean()
+    size = 1 << (2 * len(envelope) - 1).bit_length()
+    spectrum = np.fft.rfft(envelope, size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:len(envelope)]
+    bpms = np.arange(MIN_BPM, MAX_BPM + 1)
+    strength = np.interp(fps * 60 / bpms, np.arange(len(autocorrelation)), autocorrelation)
+    prior = np.exp(-0.5 * np.log2(bpms / 120) ** 2)
+    return int(bpms[np.argmax(strength * prior)])
+
+
+# the offset in frames of the beat grid that lines up best with the flux, moved back by whole beats so
+# that no onset comes before it
+def estimate_phase(flux, onsets, beat_frames):
+    phases = np.arange(int(np.ceil(beat_frames)))
+    beats = np.arange(int(len(flux) // beat_frames) + 1)
+    positions = phases[:, None] + beats[None, :] * beat_frames
+    score = np.interp(positions, np.arange(len(flux)), flux, right=0).sum(axis=1)
+    phase = phases[np.argmax(score)]
+    return phase - np.ceil(max(phase - onsets.min(), 0) / beat_frames) * beat_frames
+
+
+# which instruments sounded at each onset: every onset's band energy is fitted as a non-negative mix of
+# the instrument templates (multiplicative updates, all onsets at once), and an instrument is played where
+# it carries at least MIN_SHARE of the fit. Every onset gets at least its strongest instrument.
+def classify(levels, templates):
+    scale = np.maximum(np.percentile(levels, 90, axis=0), 1e-9)
+    levels = levels / scale
+    templates = templates / scale
+    templates = templates / templates.sum(axis=1, keepdims=True)
+    activation = np.repeat(levels.sum(axis=1, keepdims=True).clip(1e-9) / len(templates), len(templates), axis=1)
+    gram = templates @ templates.T
+    target = levels @ templates.T
+    for _ in range(FIT_ITERATIONS):
+        activation *= target / np.maximum(activation @ gram, 1e-12)
+    share = activation / np.maximum(activation.sum(axis=1, keepdims=True), 1e-12)
+    hits = share >= MIN_SHARE
+    hits[np.arange(len(share)), np.argmax(share, axis=1)] = True
+    return hits
+
+
+# returns {'bpm', 'beat_schema', 'onsets'}; raises ValueError for unreadable or empty recordings
+def transcribe(stream, steps_per_bar=16):
+    analysis = None
+    for rate, chunk in iter_wav(stream, MAX_SECONDS):
+        if analysis is None:
+            analysis = _SpectralFlux(rate)
+        analysis.feed(chunk)
+    if analysis is None:
+        raise ValueError('the recording is empty')
+    flux, band_magnitude = analysis.result()
+    onsets = detect_onsets(flux)
+    if len(onsets) < 2:
+        raise ValueError('no drum hits found in the recording')
+
+    fps = analysis.rate / analysis.hop
+    bpm = estimate_tempo(flux, fps)
+    beat_frames = fps * 60 / bpm
+    step_frames = beat_frames * BEATS_PER_BAR / steps_per_bar
+    phase = estimate_phase(flux, onsets, beat_frames)
+    steps = np.rint((onsets - phase) / step_frames).astype(np.int64)
+    keep = steps < MAX_BARS * steps_per_bar
+    steps, onsets = steps[keep], onsets[keep]
+
+    strength = flux[onsets] / flux[onsets].max()
+    velocity = np.clip(np.rint(40 + 87 * strength), 2, 127).astype(np.int16)
+    levels = band_levels(band_magnitude, onsets, analysis.frame, analysis.hop)
+    hits = classify(levels, band_templates(analysis.rate, analysis.frame))
+    bars = int(steps.max()) // steps_per_bar + 1
+    grid = np.zeros((len(INSTRUMENTS), bars * steps_per_bar), dtype=np.int16)
+    onset_index, instrument = np.nonzero(hits)
+    np.maximum.at(grid, (instrument, steps[onset_index]), velocity[onset_index])
+    return {'bpm': bpm, 'beat_schema': encode_grid(grid.reshape(len(INSTRUMENTS), bars, steps_per_bar)),
+            'onsets': int(len(onsets))}
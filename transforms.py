@@ -0,0 +1,106 @@
+import numpy as np
+from grid import INSTRUMENTS, DEFAULT_VELOCITY, decode_grid, encode_grid, velocities
+
+# every transform takes a batch of same-shaped grids (n, instruments, bars, steps) and returns a new batch
+
+
+def _flat(grids):
+    return grids.reshape(grids.shape[0], grids.shape[1], -1)
+
+
+# back from effective velocities to cell values, where 1 means a hit at the default velocity
+def _to_cells(vel):
+    return np.where(vel == DEFAULT_VELOCITY, 1, vel).astype(np.int16)
+
+
+def _place(vel, index, positions, length):
+    out = np.zeros(vel.shape[:2] + (length,), dtype=np.int16)
+    np.maximum.at(out, index[:2] + (positions,), vel[index])
+    return out
+
+
+# twice as fast: two bars fit into one, so bars hold twice the steps
+def double_time(grids, **_):
+    n, k, bars, steps = grids.shape
+    flat = _flat(grids)
+    flat = np.pad(flat, ((0, 0), (0, 0), (0, (bars % 2) * steps)))
+    return flat.reshape(n, k, -1, steps * 2)
+
+
+# half as fast: a rest after every step, so the beat takes twice the bars
+def half_time(grids, **_):
+    n, k, bars, steps = grids.shape
+    out = np.zeros((n, k, bars * steps * 2), dtype=grids.dtype)
+    out[:, :, ::2] = _flat(grids)
+    return out.reshape(n, k, bars * 2, steps)
+
+
+def rotate(grids, steps=1, **_):
+    return np.roll(_flat(grids), steps, axis=-1).reshape(grids.shape)
+
+
+def mirror(grids, **_):
+    return _flat(grids)[:, :, ::-1].reshape(grids.shape)
+
+
+def mute(grids, instruments=(), **_):
+    out = grids.copy()
+    out[:, [INSTRUMENTS.index(instrument) for instrument in instruments]] = 0
+    return out
+
+
+# snap every hit to the nearest step of a coarser grid, keeping the loudest hit where several land
+def quantize(grids, steps_per_bar=None, **_):
+    n, k, bars, steps = grids.shape
+    if not steps_per_bar or steps % steps_per_bar:
+        raise ValueError(f'quantize needs steps_per_bar dividing {steps}')
+    group = steps // steps_per_bar
+    vel = velocities(_flat(grids))
+    index = np.nonzero(vel)
+    positions = np.floor(index[2] / group + 0.5).astype(np.int64) % (bars * steps_per_bar)
+    return _to_cells(_place(vel, index, positions, bars * steps_per_bar)).reshape(n, k, bars, steps_per_bar)
+
+
+# random velocity jitter of up to +-velocity and, with probability timing, a hit moved one step either way
+def humanize(grids, velocity=12, timing=0.1, seed=None, **_):
+    n, k, bars, steps = grids.shape
+    rng = np.random.default_rng(seed)
+    vel = velocities(_flat(grids)).astype(np.int16)
+    index = np.nonzero(vel)
+    jitter = rng.integers(-velocity, velocity + 1, size=len(index[0]))
+    vel[index] = np.clip(vel[index] + jitter, 2, 127)
+    shift = rng.choice([-1, 0, 1], size=len(index[0]), p=[timing / 2, 1 - timing, timing / 2])
+    positions = (index[2] + shift) % (bars * steps)
+    return _to_cells(_place(vel, index, positions, bars * steps)).reshape(grids.shape)
+
+
+TRANSFORMS = {
+    'double_time': double_time,
+    'half_time': half_time,
+    'rotate': rotate,
+    'mirror': mirror,
+    'mute': mute,
+    'quantize': quantize,
+    'humanize': humanize,
+}
+
+
+def apply_transforms(grids, transforms):
+    for transform in transforms:
+        grids = TRANSFORMS[transform['op']](grids, **{k: v for k, v in transform.items() if k != 'op'})
+    return grids
+
+
+# transform many beat_schemas at once, stacking same-shaped grids into one array per shape
+def transform_schemas(beat_schemas, transforms):
+    groups = {}
+    for i, beat_schema in enumerate(beat_schemas):
+        grid = decode_grid(beat_schema)
+        groups.setdefault(grid.shape, []).append((i, grid))
+
+    results = [None] * len(beat_schemas)
+    for group in groups.values():
+        out = apply_transforms(np.stack([grid for _, grid in group]), transforms)
+        for (i, _), grid in zip(group, out):
+            results[i] = encode_grid(grid)
+    return results